@@ -0,0 +1,157 @@
+"""Query plans and timings for the hot filters, before and after migrations.
+
+Builds throwaway copies of orders.db and products.db filled with synthetic
+rows, runs the queries behind the slow routes, applies the migrations from
+migrations.py and runs them again.
+
+    python benchmarks/index_plans.py [--products 200000] [--orders 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from migrations import apply_migrations, ORDERS_MIGRATIONS, PRODUCTS_MIGRATIONS
+
+WAREHOUSES = ["ENDER", "ANKARA", "IZMIR", "BURSA"]
+
+PRODUCT_QUERIES = [
+    ("package lookup (get_gts_status, update_product)",
+     "SELECT * FROM products WHERE package_barcode = :package"),
+    ("/stock/summary",
+     "SELECT package_barcode, warehouse, SUM(amount), COUNT(barcode) FROM products "
+     "WHERE in_stock = 1 GROUP BY package_barcode, warehouse"),
+    ("/stock/warehouse_summary",
+     "SELECT warehouse, COUNT(barcode), SUM(amount) FROM products "
+     "WHERE in_stock = 1 GROUP BY warehouse"),
+]
+
+ORDER_QUERIES = [
+    ("/payments/<order_id>",
+     "SELECT * FROM payment_log WHERE order_id = :order"),
+    ("get_one_client_orders",
+     "SELECT * FROM client_order WHERE client_id = :client"),
+]
+
+
+def create_products(engine, count):
+    packages = max(count // 24, 1)
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE products (barcode VARCHAR PRIMARY KEY, package_barcode VARCHAR, "
+            "pallet_barcode VARCHAR, shipment_number VARCHAR, delivery_number VARCHAR, "
+            "batch_number VARCHAR, production_date VARCHAR, end_date VARCHAR, order_id VARCHAR, "
+            "amount FLOAT, is_gts_done BOOLEAN, warehouse VARCHAR, in_stock BOOLEAN)"
+        ))
+        conn.execute(text(
+            "INSERT INTO products (barcode, package_barcode, amount, is_gts_done, warehouse, in_stock) "
+            "VALUES (:barcode, :package, 0.25, :done, :warehouse, :in_stock)"
+        ), [{
+            'barcode': f"QR{i:09d}",
+            'package': f"PK{i % packages:07d}",
+            'done': random.random() < 0.5,
+            'warehouse': random.choice(WAREHOUSES),
+            'in_stock': random.random() < 0.8,
+        } for i in range(count)])
+    return {'package': f"PK{packages // 2:07d}"}
+
+
+def create_orders(engine, count):
+    clients = max(count // 4, 1)
+    with engine.begin() as conn:
+        # Same tables as the Client and ClientOrder models: the migrations'
+        # triggers (search index) refer to their columns
+        conn.execute(text(
+            "CREATE TABLE client (id VARCHAR PRIMARY KEY, name VARCHAR NOT NULL, phone_number VARCHAR NOT NULL, "
+            "district VARCHAR NOT NULL, address VARCHAR NOT NULL, tc VARCHAR NOT NULL, birthday VARCHAR NOT NULL, "
+            "source VARCHAR NOT NULL, comments VARCHAR, email VARCHAR, title VARCHAR NOT NULL, "
+            "gts_number VARCHAR NOT NULL)"
+        ))
+        conn.execute(text(
+            "CREATE TABLE client_order (id VARCHAR(30) PRIMARY KEY, client_id VARCHAR(100) NOT NULL, "
+            "quantity FLOAT NOT NULL, quantity_text VARCHAR(200) NOT NULL, price INTEGER, remaining_amount INTEGER, "
+            "is_receipt_done BOOLEAN, is_gts_done BOOLEAN, cargo_barcode VARCHAR(100), gts_barcode VARCHAR(100), "
+            "order_type VARCHAR(100), last_update VARCHAR(100), purchase_date VARCHAR(20), comments VARCHAR(1000), "
+            "delivery_status VARCHAR(100), yield_type VARCHAR(100), intermediar_id VARCHAR(100), "
+            "intermediar_amount INTEGER, product_type VARCHAR(50))"
+        ))
+        conn.execute(text(
+            "CREATE TABLE payment_log (id VARCHAR(30) PRIMARY KEY, order_id VARCHAR(30) NOT NULL, "
+            "amount INTEGER NOT NULL, payment_date VARCHAR(20) NOT NULL, method VARCHAR(50), note VARCHAR(500))"
+        ))
+        conn.execute(text(
+            "INSERT INTO client_order (id, client_id, quantity, quantity_text, price) "
+            "VALUES (:id, :client, 10, '10 lt', 100)"
+        ), [{'id': f"O{i:08d}", 'client': f"C{i % clients:07d}"} for i in range(count)])
+        conn.execute(text(
+            "INSERT INTO payment_log (id, order_id, amount, payment_date) "
+            "VALUES (:id, :order, 100, '2024-01-01 10:00:00')"
+        ), [{'id': f"P{i:08d}", 'order': f"O{i % count:08d}"} for i in range(count * 2)])
+    return {'order': f"O{count // 2:08d}", 'client': f"C{clients // 2:07d}"}
+
+
+def measure(engine, sql, params, repeat=20):
+    with engine.connect() as conn:
+        plan = [row[-1] for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql), params)]
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(text(sql), params).fetchall()
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+    return plan, timings[len(timings) // 2] * 1000
+
+
+def report(engine, queries, params):
+    results = {}
+    for label, sql in queries:
+        results[label] = measure(engine, sql, params)
+    return results
+
+
+def print_comparison(before, after):
+    for label in before:
+        plan_before, ms_before = before[label]
+        plan_after, ms_after = after[label]
+        print(f"\n{label}")
+        print(f"  before: {ms_before:8.3f} ms  {' | '.join(plan_before)}")
+        print(f"  after:  {ms_after:8.3f} ms  {' | '.join(plan_after)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=200000)
+    parser.add_argument('--orders', type=int, default=20000)
+    args = parser.parse_args()
+
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        product_engine = create_engine(f"sqlite:///{os.path.join(tmp, 'products.db')}")
+        orders_engine = create_engine(f"sqlite:///{os.path.join(tmp, 'orders.db')}")
+
+        product_params = create_products(product_engine, args.products)
+        order_params = create_orders(orders_engine, args.orders)
+
+        before = {**report(product_engine, PRODUCT_QUERIES, product_params),
+                  **report(orders_engine, ORDER_QUERIES, order_params)}
+
+        apply_migrations(product_engine, PRODUCTS_MIGRATIONS)
+        apply_migrations(orders_engine, ORDERS_MIGRATIONS)
+
+        after = {**report(product_engine, PRODUCT_QUERIES, product_params),
+                 **report(orders_engine, ORDER_QUERIES, order_params)}
+
+        print(f"{args.products} products, {args.orders} orders, {args.orders * 2} payments (median of 20 runs)")
+        print_comparison(before, after)
+
+        product_engine.dispose()
+        orders_engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
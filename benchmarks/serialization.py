@@ -0,0 +1,178 @@
+"""Per-row cost of serving a list route: ORM objects vs Core rows.
+
+Fills a throwaway client_order table and times the two ways the order list
+routes have built their JSON: hydrating ORM objects, copying them into a
+hand-written dict and encoding with the standard json module, against
+selecting the field table's columns as Core rows, zipping them with the
+field table's keys and encoding with orjson.
+
+    python benchmarks/serialization.py [--rows 50000]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import orjson
+from sqlalchemy import create_engine, select, Column, String, Integer, Float, Boolean
+from sqlalchemy.orm import Session, declarative_base
+
+Base = declarative_base()
+
+
+class ClientOrder(Base):
+    __tablename__ = 'client_order'
+
+    id = Column(String(30), primary_key=True)
+    client_id = Column(String(100), nullable=False)
+    quantity = Column(Float, nullable=False)
+    quantity_text = Column(String(200), nullable=False)
+    price = Column(Integer)
+    remaining_amount = Column(Integer)
+    is_receipt_done = Column(Boolean)
+    is_gts_done = Column(Boolean)
+    cargo_barcode = Column(String(100))
+    gts_barcode = Column(String(100))
+    order_type = Column(String(100))
+    last_update = Column(String(100))
+    purchase_date = Column(String(20))
+    comments = Column(String(1000))
+    delivery_status = Column(String(100))
+    yield_type = Column(String(100))
+    intermediar_id = Column(String(100))
+    intermediar_amount = Column(Integer)
+    product_type = Column(String(50))
+
+
+# Same shape as CLIENT_ORDER_FIELDS in order_tracking_app.py
+CLIENT_ORDER_FIELDS = {
+    'id': ClientOrder.id,
+    'clientId': ClientOrder.client_id,
+    'quantity': ClientOrder.quantity,
+    'quantityText': ClientOrder.quantity_text,
+    'price': ClientOrder.price,
+    'remainingAmount': ClientOrder.remaining_amount,
+    'isReceiptDone': ClientOrder.is_receipt_done,
+    'isGTSDone': ClientOrder.is_gts_done,
+    'cargoBarcode': ClientOrder.cargo_barcode,
+    'gtsBarcode': ClientOrder.gts_barcode,
+    'orderType': ClientOrder.order_type,
+    'lastUpdate': ClientOrder.last_update,
+    'purchaseDate': ClientOrder.purchase_date,
+    'comments': ClientOrder.comments,
+    'deliveryStatus': ClientOrder.delivery_status,
+    'yieldType': ClientOrder.yield_type,
+    'intermediarId': ClientOrder.intermediar_id,
+    'intermediarAmount': ClientOrder.intermediar_amount,
+    'productType': ClientOrder.product_type,
+}
+
+
+def create_orders(engine, count):
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(ClientOrder.__table__.insert(), [{
+            'id': f"O{i:08d}",
+            'client_id': f"C{i % 1000:07d}",
+            'quantity': 10,
+            'quantity_text': '10 lt',
+            'price': 100,
+            'remaining_amount': 500,
+            'is_receipt_done': i % 3 == 0,
+            'is_gts_done': i % 2 == 0,
+            'cargo_barcode': f"K{i}",
+            'gts_barcode': f"G{i}",
+            'order_type': 'web',
+            'purchase_date': '2024-01-01',
+            'comments': 'teslimat sabah',
+            'delivery_status': 'new',
+            'product_type': 'Cropsil',
+        } for i in range(count)])
+
+
+def orm_path(engine):
+    timings = {}
+    with Session(engine) as session:
+        start = time.perf_counter()
+        orders = session.query(ClientOrder).all()
+        timings['query'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rows = [{
+            "id": order.id,
+            "clientId": order.client_id,
+            "quantity": order.quantity,
+            "quantityText": order.quantity_text,
+            "price": order.price,
+            "remainingAmount": order.remaining_amount,
+            "isReceiptDone": order.is_receipt_done,
+            "isGTSDone": order.is_gts_done,
+            "cargoBarcode": order.cargo_barcode,
+            "gtsBarcode": order.gts_barcode,
+            "orderType": order.order_type,
+            "lastUpdate": order.last_update,
+            "purchaseDate": order.purchase_date,
+            "comments": order.comments,
+            "deliveryStatus": order.delivery_status,
+            "yieldType": order.yield_type,
+            "intermediarId": order.intermediar_id,
+            "intermediarAmount": order.intermediar_amount,
+            "productType": order.product_type,
+        } for order in orders]
+        timings['serialize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # Flask's default provider: sorted keys, compact separators
+    json.dumps(rows, sort_keys=True, separators=(",", ":")).encode()
+    timings['encode'] = time.perf_counter() - start
+    return timings
+
+
+def core_path(engine):
+    timings = {}
+    with Session(engine) as session:
+        start = time.perf_counter()
+        result = session.execute(select(*CLIENT_ORDER_FIELDS.values())).all()
+        timings['query'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rows = [dict(zip(CLIENT_ORDER_FIELDS, row)) for row in result]
+        timings['serialize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    orjson.dumps(rows, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    timings['encode'] = time.perf_counter() - start
+    return timings
+
+
+def best_of(path, engine, repeat):
+    runs = [path(engine) for _ in range(repeat)]
+    return {step: min(run[step] for run in runs) for step in runs[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'orders.db')}")
+        create_orders(engine, args.rows)
+
+        before = best_of(orm_path, engine, args.repeat)
+        after = best_of(core_path, engine, args.repeat)
+        engine.dispose()
+
+    print(f"{args.rows} client orders, microseconds per row (best of {args.repeat} runs)")
+    print(f"{'':12}{'ORM + json':>12}{'Core + orjson':>16}")
+    for step in ('query', 'serialize', 'encode'):
+        print(f"{step:12}{before[step] / args.rows * 1e6:12.2f}{after[step] / args.rows * 1e6:16.2f}")
+    total_before = sum(before.values()) / args.rows * 1e6
+    total_after = sum(after.values()) / args.rows * 1e6
+    print(f"{'total':12}{total_before:12.2f}{total_after:16.2f}  ({total_before / total_after:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
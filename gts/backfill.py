@@ -0,0 +1,171 @@
+"""Chunked, resumable column backfills for the order database.
+
+Sets columns to constant values with set-based UPDATE statements over
+rowid ranges, committing after every batch so the write lock is only held
+for one batch at a time. Progress is checkpointed in the job_progress table
+in the same transaction as each batch, so an interrupted run picks up where
+it stopped when started again with the same arguments. As for every job in
+that table, processed/total count the rows of the current run and cursor is
+the resume point.
+
+    python backfill.py --table client_order --set product_type=Cropsil \
+        --set intermediar_amount=0 --where "product_type IS NULL" --dry-run
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from sqlalchemy import create_engine, text
+
+# migrations.py lives in the project root; the scripts run from gts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from migrations import CREATE_TABLE_VERSIONS, bump_table_versions
+
+# Database file name
+db_file = '../instance/orders.db'
+DATABASE_URL = f'sqlite:///{db_file}'
+
+DEFAULT_BATCH_SIZE = 5000
+
+CREATE_JOB_PROGRESS = (
+    "CREATE TABLE IF NOT EXISTS job_progress ("
+    "job VARCHAR(200) PRIMARY KEY, "
+    "cursor VARCHAR(200), "
+    "processed INTEGER NOT NULL DEFAULT 0, "
+    "total INTEGER, "
+    "status VARCHAR(20) NOT NULL, "
+    "started_at VARCHAR(20), "
+    "updated_at VARCHAR(20))"
+)
+
+def now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def parse_assignment(assignment):
+    # "column=value"; the value is read as JSON when possible (0, true, null,
+    # "text") and as a plain string otherwise, so "product_type=Cropsil" works
+    column, sep, raw = assignment.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected column=value, got '{assignment}'")
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        value = raw
+    return column.strip(), value
+
+def job_name(table, values, where):
+    digest = hashlib.sha1(json.dumps([values, where], sort_keys=True).encode()).hexdigest()[:12]
+    return f"backfill:{table}:{digest}"
+
+def check_columns(connection, table, columns):
+    existing = {row[1] for row in connection.execute(text(f'PRAGMA table_info("{table}")'))}
+    if not existing:
+        raise ValueError(f"Table '{table}' does not exist.")
+    unknown = [column for column in columns if column not in existing]
+    if unknown:
+        raise ValueError(f"Unknown columns for '{table}': {', '.join(unknown)}")
+
+def run_backfill(engine, table, values, where=None, batch_size=DEFAULT_BATCH_SIZE,
+                 dry_run=False, job=None, restart=False):
+    """Set ``values`` ({column: value}) on every row of ``table`` matching ``where``.
+
+    Returns the number of rows updated by this run (or that would be, for a dry run).
+    """
+    condition = f"({where})" if where else "1"
+    job = job or job_name(table, values, where)
+
+    with engine.begin() as connection:
+        check_columns(connection, table, values)
+        connection.execute(text(CREATE_JOB_PROGRESS))
+        connection.execute(text(CREATE_TABLE_VERSIONS))
+        progress = connection.execute(
+            text("SELECT cursor, processed, status FROM job_progress WHERE job = :job"), {'job': job}
+        ).mappings().first()
+
+    if progress and progress['status'] == 'done' and not restart:
+        print(f"Job {job} already finished. Use --restart to run it again.")
+        return 0
+
+    resume = progress is not None and not restart
+    cursor = int(progress['cursor']) if resume and progress['cursor'] else 0
+
+    with engine.connect() as connection:
+        remaining = connection.execute(
+            text(f'SELECT COUNT(*) FROM "{table}" WHERE rowid > :cursor AND {condition}'), {'cursor': cursor}
+        ).scalar()
+
+    if resume:
+        print(f"Resuming {job} after rowid {cursor}.")
+    print(f"{remaining} rows in '{table}' to update in batches of {batch_size}.")
+    if dry_run:
+        return remaining
+
+    assignments = ", ".join(f'"{column}" = :set_{column}' for column in values)
+    params = {f"set_{column}": value for column, value in values.items()}
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO job_progress (job, cursor, processed, total, status, started_at, updated_at) "
+            "VALUES (:job, :cursor, 0, :total, 'running', :now, :now) "
+            "ON CONFLICT(job) DO UPDATE SET cursor = excluded.cursor, processed = 0, total = excluded.total, "
+            "status = 'running', started_at = excluded.started_at, updated_at = excluded.updated_at"
+        ), {'job': job, 'cursor': str(cursor), 'total': remaining, 'now': now()})
+
+    started = time.perf_counter()
+    updated = 0
+    while True:
+        with engine.begin() as connection:
+            # Upper rowid of the next batch of matching rows
+            upto = connection.execute(text(
+                f'SELECT MAX(rowid) FROM (SELECT rowid FROM "{table}" '
+                f'WHERE rowid > :cursor AND {condition} ORDER BY rowid LIMIT :batch_size)'
+            ), {'cursor': cursor, 'batch_size': batch_size}).scalar()
+            if upto is None:
+                connection.execute(text(
+                    "UPDATE job_progress SET status = 'done', updated_at = :now WHERE job = :job"
+                ), {'job': job, 'now': now()})
+                break
+
+            result = connection.execute(text(
+                f'UPDATE "{table}" SET {assignments} WHERE rowid > :cursor AND rowid <= :upto AND {condition}'
+            ), {**params, 'cursor': cursor, 'upto': upto})
+
+            cursor = upto
+            updated += result.rowcount
+            if result.rowcount:
+                bump_table_versions(connection, table)
+            connection.execute(text(
+                "UPDATE job_progress SET cursor = :cursor, processed = :processed, updated_at = :now WHERE job = :job"
+            ), {'job': job, 'cursor': str(cursor), 'processed': updated, 'now': now()})
+
+        elapsed = time.perf_counter() - started
+        print(f"Updated {updated}/{remaining} rows (up to rowid {cursor}, {updated / elapsed:.0f} rows/s).")
+
+    print(f"Backfill {job} complete: {updated} rows updated.")
+    return updated
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill columns with chunked set-based UPDATEs.")
+    parser.add_argument('--db', default=db_file, help="SQLite database file")
+    parser.add_argument('--table', required=True)
+    parser.add_argument('--set', dest='values', action='append', type=parse_assignment, required=True,
+                        metavar='COLUMN=VALUE', help="column to set; repeat for several columns")
+    parser.add_argument('--where', help="SQL condition selecting the rows to update")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--dry-run', action='store_true', help="only count the rows that would be updated")
+    parser.add_argument('--job', help="checkpoint name; derived from the arguments by default")
+    parser.add_argument('--restart', action='store_true', help="ignore an existing checkpoint")
+    args = parser.parse_args()
+
+    engine = create_engine(f'sqlite:///{args.db}')
+    try:
+        run_backfill(engine, args.table, dict(args.values), where=args.where, batch_size=args.batch_size,
+                     dry_run=args.dry_run, job=args.job, restart=args.restart)
+    except ValueError as e:
+        parser.error(str(e))
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,27 @@
 import pandas as pd
 import glob
-from sqlalchemy import create_engine, Column, Float, String, Boolean
-from sqlalchemy.orm import sessionmaker
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import create_engine, Column, Float, String, Boolean, text
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.declarative import declarative_base
 
+# migrations.py lives in the project root; the scripts run from gts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from migrations import CREATE_TABLE_VERSIONS, bump_table_versions
+
 # Specify the pattern for your CSV files
 file_pattern = 'csv_files/*.csv'
 
-# Get a list of all CSV files
-csv_files = glob.glob(file_pattern)
-
 # Database file name
 db_file = 'products.db'
 database_url = f'sqlite:///{db_file}'
 
+# Rows per INSERT ... ON CONFLICT batch; every file is written in one transaction
+BATCH_SIZE = 10000
+
 # SQLAlchemy setup
 Base = declarative_base()
 
@@ -34,79 +42,100 @@ class Product(Base):
     warehouse = Column(String)
     in_stock = Column(Boolean, nullable=True)
 
-engine = create_engine(database_url)
-Base.metadata.create_all(engine)
-
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-def insert_or_update_product(db: SessionLocal, product_data: dict):
-    db_product = db.query(Product).filter(Product.barcode == product_data['QR Kod']).first()
-    if db_product:
-        # Update existing record
-        for key, value in product_data.items():
-            setattr(db_product, key.lower().replace(' ', '_'), value)
-    else:
-        # Create new record
-        new_product = Product(
-            barcode=product_data['QR Kod'],
-            package_barcode=product_data['Paket / Koli Barkodu'],
-            pallet_barcode=product_data['Palet Barkodu'],
-            shipment_number=product_data['Sevk No'],
-            delivery_number=product_data['İrsaliye No'],
-            batch_number=product_data['Parti No'],
-            production_date=product_data['Üretim Tarihi'],
-            end_date=product_data['Son Kullanma Tarihi'],
-            order_id="",
-            amount=0.25,
-            is_gts_done=False,
-            warehouse="Ender",
-            in_stock=True
-        )
-        db.add(new_product)
-    db.commit()
-
-for file_path in csv_files:
+# CSV header -> products column
+COLUMN_MAP = {
+    'QR Kod': 'barcode',
+    'Paket / Koli Barkodu': 'package_barcode',
+    'Palet Barkodu': 'pallet_barcode',
+    'Sevk No': 'shipment_number',
+    'İrsaliye No': 'delivery_number',
+    'Parti No': 'batch_number',
+    'Üretim Tarihi': 'production_date',
+    'Son Kullanma Tarihi': 'end_date',
+}
+expected_columns = list(COLUMN_MAP)
+
+# Only set on new products; re-importing a file must not reset GTS or stock state
+NEW_PRODUCT_DEFAULTS = {
+    'order_id': "",
+    'amount': 0.25,
+    'is_gts_done': False,
+    'warehouse': "Ender",
+    'in_stock': True,
+}
+
+def read_products(file_path):
+    """Parse one shipment CSV into product rows. Runs in a worker process.
+
+    Returns (file_path, rows, error message).
+    """
     try:
         # Read the CSV file
-        df = pd.read_csv(file_path, skiprows=3, header=None, sep=';')
-
-        if not df.empty:
-            expected_columns = ['QR Kod', 'Paket / Koli Barkodu', 'Palet Barkodu', 'Sevk No', 'İrsaliye No', 'Parti No', 'Üretim Tarihi', 'Son Kullanma Tarihi']
-            num_expected_columns = len(expected_columns)
-            num_columns = len(df.columns)
-
-            print(f"Processing file: {file_path} for database insertion (SQLAlchemy)...")
-
-            if num_columns == num_expected_columns:
-                df.columns = expected_columns
-
-                db = next(get_db())
-                # Iterate through each row and insert/update using SQLAlchemy
-                for index, row in df.iterrows():
-                    product_data = row.to_dict()
-                    insert_or_update_product(db, product_data)
-                db.close()
-
-                print(f"Successfully inserted/updated data from {file_path} into the database (SQLAlchemy).")
-
-            else:
-                print(f"Error: Column mismatch in {file_path}. Expected {num_expected_columns} columns, but found {num_columns}.")
-
-        else:
-            print(f"Warning: No data found in {file_path} after skipping the first two rows.")
-
+        df = pd.read_csv(file_path, skiprows=3, header=None, sep=';', dtype=str)
     except FileNotFoundError:
-        print(f"Error: File not found - {file_path}")
+        return file_path, None, f"Error: File not found - {file_path}"
     except pd.errors.EmptyDataError:
-        print(f"Error: Empty data in file - {file_path}")
+        return file_path, None, f"Error: Empty data in file - {file_path}"
     except Exception as e:
-        print(f"An error occurred while processing {file_path}: {e}")
+        return file_path, None, f"An error occurred while processing {file_path}: {e}"
+
+    if df.empty:
+        return file_path, None, f"Warning: No data found in {file_path} after skipping the first two rows."
+
+    num_expected_columns = len(expected_columns)
+    num_columns = len(df.columns)
+    if num_columns != num_expected_columns:
+        return file_path, None, f"Error: Column mismatch in {file_path}. Expected {num_expected_columns} columns, but found {num_columns}."
+
+    df.columns = [COLUMN_MAP[column] for column in expected_columns]
+    df = df.dropna(subset=['barcode']).drop_duplicates(subset='barcode', keep='last')
+    df = df.astype(object).where(df.notna(), None).assign(**NEW_PRODUCT_DEFAULTS)
+    return file_path, df.to_dict('records'), None
+
+def upsert_products(connection, rows):
+    stmt = insert(Product.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['barcode'],
+        set_={column: stmt.excluded[column] for column in COLUMN_MAP.values() if column != 'barcode'}
+    )
+    for start in range(0, len(rows), BATCH_SIZE):
+        connection.execute(stmt, rows[start:start + BATCH_SIZE])
+
+def main():
+    engine = create_engine(database_url)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text(CREATE_TABLE_VERSIONS))
+
+    # Get a list of all CSV files
+    csv_files = glob.glob(file_pattern)
+
+    started = time.perf_counter()
+    total_rows = 0
+
+    # Files are parsed in parallel; SQLite has a single writer, so the parsed
+    # rows are written from this process one file (= one transaction) at a time
+    with ProcessPoolExecutor() as pool:
+        for file_path, rows, error in pool.map(read_products, csv_files):
+            if error:
+                print(error)
+                continue
 
-print("\nData processing and database update complete (SQLAlchemy).")
\ No newline at end of file
+            print(f"Processing file: {file_path} for database insertion (SQLAlchemy)...")
+            try:
+                with engine.begin() as connection:
+                    upsert_products(connection, rows)
+                    bump_table_versions(connection, 'products')
+            except Exception as e:
+                print(f"An error occurred while processing {file_path}: {e}")
+                continue
+
+            total_rows += len(rows)
+            print(f"Successfully inserted/updated {len(rows)} rows from {file_path} into the database (SQLAlchemy).")
+
+    elapsed = time.perf_counter() - started
+    rate = total_rows / elapsed if elapsed else 0
+    print(f"\nData processing and database update complete (SQLAlchemy): {total_rows} rows in {elapsed:.1f}s ({rate:.0f} rows/s).")
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,19 @@
+import argparse
 import pandas as pd
 import glob
-from sqlalchemy import create_engine, Column, Float, String, Boolean
-from sqlalchemy.orm import sessionmaker
+import os
+import sys
+import time
+from sqlalchemy import create_engine, Column, Float, String, Boolean, text
 from sqlalchemy.ext.declarative import declarative_base
 
+# migrations.py lives in the project root; the scripts run from gts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from migrations import CREATE_TABLE_VERSIONS, bump_table_versions
+
 # Specify the pattern for your CSV files
 file_pattern = './stok_bilgisi.csv'
 
-# Get a list of all CSV files
-csv_files = glob.glob(file_pattern)
-
 # Database file name
 db_file = '../instance/products.db'
 database_url = f'sqlite:///{db_file}'
@@ -34,69 +38,127 @@ class Product(Base):
     warehouse = Column(String)
     in_stock = Column(Boolean, nullable=True)
 
-engine = create_engine(database_url)
-Base.metadata.create_all(engine)
-
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-def get_db():
-    db = SessionLocal()
+# Stock CSV columns holding the package barcode and its warehouse
+PACKAGE_COLUMN = 1
+WAREHOUSE_COLUMN = 5
+
+# Warehouse assigned to packages that are no longer in the stock file
+DEFAULT_WAREHOUSE = "ENDER"
+
+def read_stock_rows(file_path):
+    df = pd.read_csv(file_path, header=None, sep=';', dtype=str, usecols=[PACKAGE_COLUMN, WAREHOUSE_COLUMN])
+    df = df.dropna(subset=[PACKAGE_COLUMN])
+    return [{'package_barcode': package, 'warehouse': warehouse}
+            for package, warehouse in zip(df[PACKAGE_COLUMN], df[WAREHOUSE_COLUMN])]
+
+# Packages in stock per warehouse, snapshotted before and after the sync
+IN_STOCK_PACKAGES = (
+    "SELECT package_barcode, MAX(warehouse) AS warehouse FROM products "
+    "WHERE in_stock = 1 AND package_barcode IS NOT NULL GROUP BY package_barcode"
+)
+
+def reconcile(connection, stock_rows):
+    """Apply the stock file to products in a handful of set-based statements.
+
+    Packages listed in the file are marked in stock in their warehouse; every
+    other product is reset to out of stock in DEFAULT_WAREHOUSE. Only rows
+    whose state actually changes are written. Returns the diff report.
+    """
+    connection.execute(text("CREATE TEMP TABLE stock_csv (package_barcode TEXT, warehouse TEXT)"))
+    connection.execute(text("CREATE TEMP TABLE stock_new (package_barcode TEXT PRIMARY KEY, warehouse TEXT)"))
+    connection.execute(text(f"CREATE TEMP TABLE stock_before AS {IN_STOCK_PACKAGES}"))
+
+    connection.execute(text("INSERT INTO stock_csv (package_barcode, warehouse) VALUES (:package_barcode, :warehouse)"), stock_rows)
+    # The last line for a package wins, as it did when rows were applied one by one
+    connection.execute(text(
+        "INSERT INTO stock_new (package_barcode, warehouse) "
+        "SELECT package_barcode, warehouse FROM stock_csv "
+        "WHERE rowid IN (SELECT MAX(rowid) FROM stock_csv GROUP BY package_barcode)"
+    ))
+
+    reset = connection.execute(text(
+        "UPDATE products SET in_stock = 0, warehouse = :default_warehouse "
+        "WHERE (in_stock IS NOT 0 OR warehouse IS NOT :default_warehouse) "
+        "AND NOT EXISTS (SELECT 1 FROM stock_new s WHERE s.package_barcode = products.package_barcode)"
+    ), {'default_warehouse': DEFAULT_WAREHOUSE})
+    assigned = connection.execute(text(
+        "UPDATE products SET in_stock = 1, warehouse = s.warehouse FROM stock_new AS s "
+        "WHERE products.package_barcode = s.package_barcode "
+        "AND (products.in_stock IS NOT 1 OR products.warehouse IS NOT s.warehouse)"
+    ))
+
+    connection.execute(text(f"CREATE TEMP TABLE stock_after AS {IN_STOCK_PACKAGES}"))
+    report = connection.execute(text(
+        "SELECT "
+        "(SELECT COUNT(*) FROM stock_before b JOIN stock_after a USING (package_barcode) "
+        " WHERE a.warehouse IS NOT b.warehouse) AS moved, "
+        "(SELECT COUNT(*) FROM stock_after a WHERE NOT EXISTS "
+        " (SELECT 1 FROM stock_before b WHERE b.package_barcode = a.package_barcode)) AS appeared, "
+        "(SELECT COUNT(*) FROM stock_before b WHERE NOT EXISTS "
+        " (SELECT 1 FROM stock_after a WHERE a.package_barcode = b.package_barcode)) AS disappeared, "
+        "(SELECT COUNT(*) FROM stock_new n WHERE NOT EXISTS "
+        " (SELECT 1 FROM stock_after a WHERE a.package_barcode = n.package_barcode)) AS unknown, "
+        "(SELECT COUNT(*) FROM stock_after) AS in_stock"
+    )).mappings().one()
+
+    for table in ('stock_csv', 'stock_new', 'stock_before', 'stock_after'):
+        connection.execute(text(f"DROP TABLE temp.{table}"))
+
+    if reset.rowcount or assigned.rowcount:
+        bump_table_versions(connection, 'products')
+
+    return dict(report, products_reset=reset.rowcount, products_assigned=assigned.rowcount)
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync products' warehouse and in_stock with the stock file.")
+    parser.add_argument('--dry-run', action='store_true', help="print the diff report and roll back")
+    args = parser.parse_args()
+
+    engine = create_engine(database_url)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text(CREATE_TABLE_VERSIONS))
+
+    # Get a list of all CSV files
+    csv_files = glob.glob(file_pattern)
+
+    stock_rows = []
+    for file_path in csv_files:
+        try:
+            print(f"Reading file: {file_path}...")
+            stock_rows.extend(read_stock_rows(file_path))
+        except FileNotFoundError:
+            print(f"Error: File not found - {file_path}")
+        except pd.errors.EmptyDataError:
+            print(f"Error: Empty data in file - {file_path}")
+        except Exception as e:
+            print(f"An error occurred while processing {file_path}: {e}")
+
+    if not stock_rows:
+        # Without stock rows every product would be reset to out of stock
+        print("Warning: No stock rows found, nothing was changed.")
+        return
+
+    started = time.perf_counter()
+    connection = engine.connect()
     try:
-        yield db
+        with connection.begin() as transaction:
+            report = reconcile(connection, stock_rows)
+            if args.dry_run:
+                transaction.rollback()
     finally:
-        db.close()
-
-db = next(get_db())
-
-db_products = db.query(Product).all()
-for product in db_products:
-    product.warehouse = "ENDER"
-    product.in_stock = False
-db.commit()
-
-def insert_or_update_product(db: SessionLocal, product_data: dict):
-    db_products = db.query(Product).filter(Product.package_barcode == product_data[1]).all()
-    
-    if db_products:
-        for product in db_products:
-        # Update existing record
-            setattr(product, "in_stock", True)
-            setattr(product, "warehouse", product_data[5])
-    db.commit()
-
-for file_path in csv_files:
-    try:
-        # Read the CSV file
-        df = pd.read_csv(file_path, header=None, sep=';')
-
-        if not df.empty:
-
-            print(f"Processing file: {file_path} for database insertion (SQLAlchemy)...")
-
-            # if num_columns == num_expected_columns:
-            #     df.columns = expected_columns
-
-            db = next(get_db())
-            # Iterate through each row and insert/update using SQLAlchemy
-            for index, row in df.iterrows():
-                product_data = row.to_dict()
-                print(product_data)
-                insert_or_update_product(db, product_data)
-            db.close()
-
-            print(f"Successfully inserted/updated data from {file_path} into the database (SQLAlchemy).")
-
-            # else:
-            #     print(f"Error: Column mismatch in {file_path}. Expected {num_expected_columns} columns, but found {num_columns}.")
-
-        else:
-            print(f"Warning: No data found in {file_path} after skipping the first two rows.")
-
-    except FileNotFoundError:
-        print(f"Error: File not found - {file_path}")
-    except pd.errors.EmptyDataError:
-        print(f"Error: Empty data in file - {file_path}")
-    except Exception as e:
-        print(f"An error occurred while processing {file_path}: {e}")
-
-print("\nData processing and database update complete (SQLAlchemy).")
\ No newline at end of file
+        connection.close()
+
+    print(f"\nStock rows: {len(stock_rows)}, packages in stock: {report['in_stock']}")
+    print(f"Moved to another warehouse: {report['moved']}")
+    print(f"Appeared in stock: {report['appeared']}")
+    print(f"Disappeared from stock: {report['disappeared']}")
+    print(f"Packages in the stock file but not in the database: {report['unknown']}")
+    print(f"Products updated: {report['products_reset'] + report['products_assigned']}")
+    if args.dry_run:
+        print("\nDry run: changes rolled back.")
+    else:
+        print(f"\nStock sync complete in {time.perf_counter() - started:.1f}s.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# Production server settings: gunicorn -c gunicorn.conf.py order_tracking_app:app
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8082')
+workers = int(os.environ.get('GUNICORN_WORKERS', min(2 * multiprocessing.cpu_count() + 1, 8)))
+# Threaded workers keep long exports from blocking a whole process
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+accesslog = '-'
+
+# Every worker writes its Prometheus metrics to files here and /metrics sums
+# them up. Set before the app (and prometheus_client) is imported; emptied on
+# every start so counters from the last run don't carry over.
+metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'order_tracking_metrics'))
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir, exist_ok=True)
+
+# Import the app once in the master so table creation and migrations run a
+# single time, then give every worker its own database connections
+preload_app = True
+
+
+def post_fork(server, worker):
+    from order_tracking_app import app, db, product_engine
+
+    with app.app_context():
+        db.engine.dispose(close=False)
+    product_engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    from order_tracking_app import multiprocess
+
+    # None when prometheus_client isn't installed
+    if multiprocess is not None:
+        multiprocess.mark_process_dead(worker.pid)
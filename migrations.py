@@ -0,0 +1,297 @@
+"""Versioned schema migrations for orders.db and instance/products.db.
+
+``db.create_all()`` only creates missing tables, so anything that changes an
+existing schema (indexes, new columns, triggers) lives here instead. Each
+database stores the number of the last applied migration in
+``PRAGMA user_version``; migrations run forward in order and every step is
+safe to re-run, so an interrupted upgrade is simply retried on next start.
+"""
+import re
+
+from sqlalchemy import text
+
+# payment_date is free text written by the apps: "2024-01-31 10:00:00",
+# "2024-01-31", or day first as "31/01/2024" or "31.01.2024", with an
+# optional time. Normalised to "YYYY-MM-DD HH:MM:SS", or NULL when unparseable.
+def payment_date_sql(column):
+    return (
+        f"CASE WHEN {column} GLOB '[0-9][0-9][./-][0-9][0-9][./-][0-9][0-9][0-9][0-9]*' "
+        f"THEN datetime(substr({column}, 7, 4) || '-' || substr({column}, 4, 2) || '-' "
+        f"|| substr({column}, 1, 2) || substr({column}, 11)) "
+        f"ELSE datetime({column}) END"
+    )
+
+# Start date ("YYYY-MM-DD") of the summary period containing a timestamp;
+# weeks start on Monday
+PAYMENT_PERIOD_SQL = {
+    'day': "date({})",
+    'week': "date({}, 'weekday 0', '-6 days')",
+    'month': "date({}, 'start of month')",
+}
+
+def period_start_case_sql(value):
+    # payment_rollup_state.period -> start of that period containing value
+    whens = " ".join(f"WHEN '{period}' THEN {expression.format(value)}"
+                     for period, expression in PAYMENT_PERIOD_SQL.items())
+    return f"CASE period {whens} END"
+
+def add_payment_log_paid_at(connection):
+    # db.create_all() already adds the column on a new database
+    columns = {row[1] for row in connection.execute(text("PRAGMA table_info(payment_log)"))}
+    if 'paid_at' not in columns:
+        connection.execute(text("ALTER TABLE payment_log ADD COLUMN paid_at DATETIME"))
+
+# A payment written into a period that is already rolled up moves that
+# period type's rolled_up_until back to the start of its period, so the
+# summary recomputes from there
+def rollup_invalidation_sql(value):
+    return (
+        f"UPDATE payment_rollup_state SET rolled_up_until = {period_start_case_sql(value)} "
+        f"WHERE {value} IS NOT NULL AND rolled_up_until > {value};"
+    )
+
+# In-stock product count and amount per (package_barcode, warehouse) and per
+# warehouse, kept up to date by triggers on products so the stock summaries
+# read a handful of rows instead of grouping the whole table. NULL keys are
+# matched with IS, like GROUP BY does.
+STOCK_ROLLUPS = {
+    'stock_package_rollups': ('package_barcode', 'warehouse'),
+    'stock_warehouse_rollups': ('warehouse',),
+}
+
+def stock_rollup_change_sql(row, sign):
+    # Adds (sign '+') or removes (sign '-') one product row from every rollup
+    statements = []
+    for table, keys in STOCK_ROLLUPS.items():
+        match = " AND ".join(f"{key} IS {row}.{key}" for key in keys)
+        if sign == '+':
+            statements.append(
+                f"INSERT INTO {table} ({', '.join(keys)}, item_count, total_amount) "
+                f"SELECT {', '.join(f'{row}.{key}' for key in keys)}, 0, 0 "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {match});"
+            )
+        statements.append(
+            f"UPDATE {table} SET item_count = item_count {sign} 1, "
+            f"total_amount = total_amount {sign} COALESCE({row}.amount, 0) WHERE {match};"
+        )
+        if sign == '-':
+            statements.append(f"DELETE FROM {table} WHERE item_count <= 0 AND {match};")
+    return " ".join(statements)
+
+# Recomputes the stock rollups from products; run by the migration and by
+# `flask rebuild-stock-rollups`
+STOCK_ROLLUP_REBUILD = [
+    step
+    for table, keys in STOCK_ROLLUPS.items()
+    for step in (
+        f"DELETE FROM {table}",
+        f"INSERT INTO {table} ({', '.join(keys)}, item_count, total_amount) "
+        f"SELECT {', '.join(keys)}, COUNT(*), SUM(COALESCE(amount, 0)) FROM products "
+        f"WHERE in_stock = 1 GROUP BY {', '.join(keys)}",
+    )
+]
+
+def digits_sql(value):
+    # value without the separators people type in phone and id numbers
+    for separator in (' ', '-', '.', '(', ')', '+', '/'):
+        value = f"replace({value}, '{separator}', '')"
+    return value
+
+def turkish_fold_sql(value):
+    # unicode61 folds case and accents but keeps the dotless i apart, so
+    # "yilmaz" wouldn't find "Yılmaz"; the search endpoint folds queries the same way
+    return f"replace(replace({value}, 'ı', 'i'), 'İ', 'i')"
+
+def joined_sql(*values):
+    return " || ' ' || ".join(f"COALESCE({value}, '')" for value in values)
+
+# Full-text search over clients and client orders. search_index is one FTS5
+# table for both, so hits are ranked together; search_docs maps each source
+# row to its search_index rowid (client ids are strings, and the implicit
+# rowids of those tables can change on VACUUM). Phone and TC numbers are also
+# indexed without separators so "05551234" finds "0555 123 45 67".
+SEARCH_COLUMNS = ('name', 'phone', 'tc', 'place', 'email', 'codes', 'comments')
+
+# source table -> {search column: SQL over {row}}
+SEARCH_SOURCES = {
+    'client': {
+        'name': turkish_fold_sql("{row}.name"),
+        'phone': joined_sql("{row}.phone_number", digits_sql("{row}.phone_number")),
+        'tc': joined_sql("{row}.tc", digits_sql("{row}.tc")),
+        'place': turkish_fold_sql(joined_sql("{row}.district", "{row}.address")),
+        'email': "{row}.email",
+        'comments': turkish_fold_sql("{row}.comments"),
+    },
+    'client_order': {
+        'codes': joined_sql("{row}.cargo_barcode", "{row}.gts_barcode"),
+        'comments': turkish_fold_sql("{row}.comments"),
+    },
+}
+
+def search_doc_sql(table, row):
+    return f"(SELECT doc_id FROM search_docs WHERE entity = '{table}' AND entity_id = {row}.id)"
+
+def search_add_sql(table, row):
+    expressions = SEARCH_SOURCES[table]
+    values = ", ".join(expressions.get(column, "NULL").format(row=row) for column in SEARCH_COLUMNS)
+    return (
+        f"INSERT INTO search_docs (entity, entity_id) SELECT '{table}', {row}.id WHERE {row}.id IS NOT NULL; "
+        f"INSERT INTO search_index (rowid, {', '.join(SEARCH_COLUMNS)}) "
+        f"SELECT {search_doc_sql(table, row)}, {values} WHERE {row}.id IS NOT NULL;"
+    )
+
+def search_remove_sql(table, row):
+    return (
+        f"DELETE FROM search_index WHERE rowid = {search_doc_sql(table, row)}; "
+        f"DELETE FROM search_docs WHERE entity = '{table}' AND entity_id = {row}.id;"
+    )
+
+def search_triggers_sql(table):
+    watched = ", ".join(['id', *sorted({
+        column for expression in SEARCH_SOURCES[table].values()
+        for column in re.findall(r"\{row\}\.(\w+)", expression)
+    })])
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN "
+        f"{search_add_sql(table, 'NEW')} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN "
+        f"{search_remove_sql(table, 'OLD')} END",
+        # Payments and GTS updates don't touch the indexed columns and don't fire this
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF {watched} ON {table} BEGIN "
+        f"{search_remove_sql(table, 'OLD')} {search_add_sql(table, 'NEW')} END",
+    ]
+
+# Refills the search index from clients and client orders; run by the
+# migration and by `flask rebuild-search-index`
+SEARCH_REBUILD = [
+    "DELETE FROM search_index",
+    "DELETE FROM search_docs",
+    *(
+        step
+        for table, expressions in SEARCH_SOURCES.items()
+        for step in (
+            f"INSERT INTO search_docs (entity, entity_id) SELECT '{table}', id FROM {table} WHERE id IS NOT NULL",
+            f"INSERT INTO search_index (rowid, {', '.join(SEARCH_COLUMNS)}) "
+            f"SELECT d.doc_id, {', '.join(expressions.get(column, 'NULL').format(row=table) for column in SEARCH_COLUMNS)} "
+            f"FROM {table} JOIN search_docs d ON d.entity = '{table}' AND d.entity_id = {table}.id",
+        )
+    ),
+    "INSERT INTO search_index (search_index) VALUES ('optimize')",
+]
+
+# Per-table write counters; the app builds its ETags from them, so every
+# writer - the app and the gts scripts - bumps them through bump_table_versions
+CREATE_TABLE_VERSIONS = (
+    "CREATE TABLE IF NOT EXISTS table_versions (name VARCHAR(50) PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)"
+)
+
+def bump_table_versions(connection, *tables):
+    # In the caller's transaction, so the counter moves with the write;
+    # takes a Connection or a Session
+    connection.execute(
+        text("INSERT INTO table_versions (name, version) VALUES (:name, 1) "
+             "ON CONFLICT(name) DO UPDATE SET version = version + 1"),
+        [{'name': table} for table in tables]
+    )
+
+# (version, description, steps) - a step is an SQL string or a callable
+# taking the open connection
+ORDERS_MIGRATIONS = [
+    (1, "Index ClientOrder.client_id and PaymentLog.order_id", [
+        "CREATE INDEX IF NOT EXISTS ix_client_order_client_id ON client_order (client_id)",
+        "CREATE INDEX IF NOT EXISTS ix_payment_log_order_id ON payment_log (order_id)",
+    ]),
+    (2, "Add table_versions, the per-table write counters behind ETags", [
+        CREATE_TABLE_VERSIONS,
+    ]),
+    (3, "Add PaymentLog.paid_at, parsed from payment_date, and the payment summary rollups", [
+        add_payment_log_paid_at,
+        f"UPDATE payment_log SET paid_at = {payment_date_sql('payment_date')} WHERE paid_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_payment_log_paid_at ON payment_log (paid_at)",
+        # Every writer (routes, imports, manual SQL) gets paid_at filled in
+        "CREATE TRIGGER IF NOT EXISTS payment_log_paid_at_insert AFTER INSERT ON payment_log "
+        "WHEN NEW.paid_at IS NULL BEGIN "
+        f"UPDATE payment_log SET paid_at = {payment_date_sql('NEW.payment_date')} WHERE rowid = NEW.rowid; END",
+        "CREATE TRIGGER IF NOT EXISTS payment_log_paid_at_update AFTER UPDATE OF payment_date ON payment_log BEGIN "
+        f"UPDATE payment_log SET paid_at = {payment_date_sql('NEW.payment_date')} WHERE rowid = NEW.rowid; END",
+        # Totals per closed period and method; rolled_up_until is the end of
+        # the rolled up range for each period type
+        "CREATE TABLE IF NOT EXISTS payment_rollups (period VARCHAR(5) NOT NULL, period_start VARCHAR(10) NOT NULL, "
+        "method VARCHAR(50) NOT NULL, total_amount INTEGER NOT NULL, payment_count INTEGER NOT NULL, "
+        "PRIMARY KEY (period, period_start, method))",
+        "CREATE TABLE IF NOT EXISTS payment_rollup_state (period VARCHAR(5) PRIMARY KEY, rolled_up_until VARCHAR(10))",
+        "CREATE TRIGGER IF NOT EXISTS payment_log_rollups_insert AFTER INSERT ON payment_log BEGIN "
+        f"{rollup_invalidation_sql('NEW.paid_at')} END",
+        "CREATE TRIGGER IF NOT EXISTS payment_log_rollups_update AFTER UPDATE OF paid_at, amount, method ON payment_log BEGIN "
+        f"{rollup_invalidation_sql('OLD.paid_at')} {rollup_invalidation_sql('NEW.paid_at')} END",
+        "CREATE TRIGGER IF NOT EXISTS payment_log_rollups_delete AFTER DELETE ON payment_log BEGIN "
+        f"{rollup_invalidation_sql('OLD.paid_at')} END",
+    ]),
+    (4, "Add the FTS5 search index over clients and client orders", [
+        "CREATE TABLE IF NOT EXISTS search_docs (doc_id INTEGER PRIMARY KEY, entity VARCHAR(20) NOT NULL, "
+        "entity_id VARCHAR(100) NOT NULL, UNIQUE (entity, entity_id))",
+        # Prefix indexes make type-ahead queries ("ali"*) index lookups
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5({', '.join(SEARCH_COLUMNS)}, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3')",
+        *(trigger for table in SEARCH_SOURCES for trigger in search_triggers_sql(table)),
+        *SEARCH_REBUILD,
+    ]),
+]
+
+PRODUCTS_MIGRATIONS = [
+    (1, "Index Product.package_barcode and the in-stock/warehouse filter", [
+        "CREATE INDEX IF NOT EXISTS ix_products_package_barcode ON products (package_barcode)",
+        # Covers the in_stock filter and both stock summary groupings
+        "CREATE INDEX IF NOT EXISTS ix_products_stock ON products (in_stock, warehouse, package_barcode, amount, barcode)",
+    ]),
+    (2, "Add table_versions, the per-table write counters behind ETags", [
+        CREATE_TABLE_VERSIONS,
+    ]),
+    (3, "Add trigger-maintained stock rollups per package/warehouse and per warehouse", [
+        "CREATE TABLE IF NOT EXISTS stock_package_rollups (package_barcode VARCHAR, warehouse VARCHAR, "
+        "item_count INTEGER NOT NULL, total_amount FLOAT NOT NULL)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_stock_package_rollups ON stock_package_rollups (package_barcode, warehouse)",
+        "CREATE TABLE IF NOT EXISTS stock_warehouse_rollups (warehouse VARCHAR, "
+        "item_count INTEGER NOT NULL, total_amount FLOAT NOT NULL)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_stock_warehouse_rollups ON stock_warehouse_rollups (warehouse)",
+        "CREATE TRIGGER IF NOT EXISTS products_stock_insert AFTER INSERT ON products WHEN NEW.in_stock = 1 BEGIN "
+        f"{stock_rollup_change_sql('NEW', '+')} END",
+        "CREATE TRIGGER IF NOT EXISTS products_stock_delete AFTER DELETE ON products WHEN OLD.in_stock = 1 BEGIN "
+        f"{stock_rollup_change_sql('OLD', '-')} END",
+        # Only writes to the summarised columns fire these; GTS updates don't
+        "CREATE TRIGGER IF NOT EXISTS products_stock_update_old "
+        "AFTER UPDATE OF in_stock, warehouse, package_barcode, amount ON products WHEN OLD.in_stock = 1 BEGIN "
+        f"{stock_rollup_change_sql('OLD', '-')} END",
+        "CREATE TRIGGER IF NOT EXISTS products_stock_update_new "
+        "AFTER UPDATE OF in_stock, warehouse, package_barcode, amount ON products WHEN NEW.in_stock = 1 BEGIN "
+        f"{stock_rollup_change_sql('NEW', '+')} END",
+        *STOCK_ROLLUP_REBUILD,
+    ]),
+]
+
+
+def schema_version(connection):
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+def apply_migrations(engine, migrations):
+    """Apply every migration newer than the database's user_version.
+
+    Returns the (version, description) pairs that were applied.
+    """
+    with engine.connect() as connection:
+        current = schema_version(connection)
+
+    applied = []
+    for version, description, steps in migrations:
+        if version <= current:
+            continue
+        with engine.begin() as connection:
+            for step in steps:
+                if callable(step):
+                    step(connection)
+                else:
+                    connection.execute(text(step))
+            connection.execute(text(f"PRAGMA user_version = {int(version)}"))
+        applied.append((version, description))
+    return applied
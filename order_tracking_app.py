@@ -1,23 +1,126 @@
 # app.py
-from io import BytesIO
-import pandas as pd
-from flask import Flask, request, send_file, jsonify, abort
-from datetime import datetime
-from sqlalchemy import create_engine, Column, String, Integer, Float, Boolean
+import csv
+import decimal
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import logging
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from flask import Flask, Response, request, send_file, jsonify, abort, make_response, stream_with_context, g, has_request_context
+from flask.json.provider import JSONProvider
+from openpyxl import Workbook, load_workbook
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, event, Column, String, Integer, Float, Boolean
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import func
+from sqlalchemy import func, select, insert, update, delete, case, or_, text, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from flask_sqlalchemy import SQLAlchemy
 import os
+import re
 from flask import jsonify
 from collections import defaultdict, Counter
 from flask import jsonify
+from migrations import (
+    apply_migrations, schema_version, ORDERS_MIGRATIONS, PRODUCTS_MIGRATIONS, PAYMENT_PERIOD_SQL, STOCK_ROLLUP_REBUILD,
+    SEARCH_REBUILD, bump_table_versions
+)
+
+# Optional response encoders; gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = multiprocess = None
+
+class ORJSONProvider(JSONProvider):
+    # jsonify() and request.get_json() through orjson. Keys stay sorted as
+    # with Flask's default provider, so response bodies don't change.
+    options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    @staticmethod
+    def default(value):
+        if isinstance(value, decimal.Decimal):
+            return str(value)
+        if hasattr(value, '__html__'):
+            return str(value.__html__())
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.options) + b"\n"
+        return self._app.response_class(body, mimetype='application/json')
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = ORJSONProvider(app)
+
+# SQLite settings shared by both engines. WAL lets report reads run while a
+# scanner writes, and the busy timeout makes writers wait for the lock
+# instead of failing with "database is locked".
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'busy_timeout': SQLITE_BUSY_TIMEOUT_MS,
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    # Negative values are KiB, e.g. -65536 for a 64 MB page cache
+    'cache_size': os.environ.get('SQLITE_CACHE_SIZE'),
+    'mmap_size': os.environ.get('SQLITE_MMAP_SIZE'),
+}
+SQLITE_ENGINE_OPTIONS = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000},
+}
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        if value not in (None, ''):
+            cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
 
 # Configure the SQLite database
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///orders.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = SQLITE_ENGINE_OPTIONS
 db = SQLAlchemy(app)
+with app.app_context():
+    event.listen(db.engine, 'connect', set_sqlite_pragmas)
 # Set the upload folder path
 UPLOAD_FOLDER = 'images'  # Change this to your desired folder
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)  # Create the folder if it doesn't exist
@@ -27,7 +130,8 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
 # Configure the second SQLite database (products.db)
 PRODUCT_DATABASE_URI = 'sqlite:///instance/products.db'
-product_engine = create_engine(PRODUCT_DATABASE_URI)
+product_engine = create_engine(PRODUCT_DATABASE_URI, **SQLITE_ENGINE_OPTIONS)
+event.listen(product_engine, 'connect', set_sqlite_pragmas)
 
 ProductBase = declarative_base()
 ProductSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=product_engine)
@@ -82,6 +186,39 @@ class PaymentLog(db.Model):
     payment_date = db.Column(db.String(20), nullable=False, default=lambda: datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
     method = db.Column(db.String(50), nullable=True)  # Cash, Credit Card, etc.
     note = db.Column(db.String(500), nullable=True)
+    # payment_date parsed to "YYYY-MM-DD HH:MM:SS" by a trigger on every
+    # write (see migrations.py); indexed for date ranges and summaries
+    paid_at = db.Column(db.DateTime, nullable=True)
+
+# Running total of PaymentLog.amount per order, updated by the payment routes
+# in the same transaction as the PaymentLog row itself
+class OrderBalance(db.Model):
+    order_id = db.Column(db.String(30), primary_key=True)
+    paid_amount = db.Column(db.Integer, nullable=False, default=0)
+
+# Checkpoints of long-running jobs, also written by gts/backfill.py.
+# processed/total count the rows of the current run; cursor is where a
+# restarted job resumes.
+class JobProgress(db.Model):
+    job = db.Column(db.String(200), primary_key=True)
+    cursor = db.Column(db.String(200), nullable=True)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    status = db.Column(db.String(20), nullable=False)
+    started_at = db.Column(db.String(20), nullable=True)
+    updated_at = db.Column(db.String(20), nullable=True)
+
+# The /events ring buffer: one row per committed change, newest
+# CHANGE_EVENTS_KEEP kept. AUTOINCREMENT so ids are never reused after trimming.
+class ChangeEvent(db.Model):
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(30), nullable=False)  # client, client_order, payment, product, package
+    entity_id = db.Column(db.String(100), nullable=True)  # None: several rows changed, refetch
+    op = db.Column(db.String(10), nullable=False)  # create, update, delete, bulk
+    fields = db.Column(db.String(1000), nullable=True)  # JSON list of changed response keys
+    created_at = db.Column(db.String(20), nullable=False)
 
 # Define the Client model
 class Client(db.Model):
@@ -120,22 +257,80 @@ class ClientOrder(db.Model):
     intermediar_amount = db.Column(db.Integer, nullable=True)
     product_type = db.Column(db.String(50), nullable=True)
 
-@app.route('/stock/summary', methods=['GET'])
-def summarize_stock():
-    # Query: group by package_barcode and warehouse, aggregate amount and count
-    product_db = next(get_product_db())
+CHANGE_EVENTS_KEEP = int(os.environ.get('CHANGE_EVENTS_KEEP', 10000))
+
+def record_changes(session, changes):
+    # Adds change records ({entity, id, op, fields}) for /events in the
+    # caller's transaction, so they only become visible once the write they
+    # describe is committed, and trims the ring buffer
+    if not changes:
+        # An empty executemany would insert one row of defaults
+        return
+    created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    session.execute(insert(ChangeEvent), [{
+        'entity': change['entity'],
+        'entity_id': change.get('id'),
+        'op': change.get('op', 'update'),
+        'fields': app.json.dumps(change['fields']) if change.get('fields') is not None else None,
+        'created_at': created_at,
+    } for change in changes])
+    session.execute(
+        text("DELETE FROM change_event WHERE id <= (SELECT MAX(id) FROM change_event) - :keep"),
+        {'keep': CHANGE_EVENTS_KEEP}
+    )
 
-    grouped_results = (
-        product_db.query(
-            Product.package_barcode,
-            Product.warehouse,
-            func.sum(Product.amount).label('total_amount'),
-            func.count(Product.barcode).label('count')
-        )
-        .filter(Product.in_stock == True)
-        .group_by(Product.package_barcode, Product.warehouse)
-        .all()
+def field_keys(field_table, column_names):
+    # The response keys of field_table for the given column names
+    names = set(column_names)
+    return [key for key, column in field_table.items() if column.key in names]
+
+def read_table_versions(session, tables):
+    rows = session.execute(
+        text("SELECT name, version FROM table_versions WHERE name IN :names").bindparams(
+            bindparam('names', expanding=True)),
+        {'names': list(tables)}
     )
+    versions = dict(rows.all())
+    return tuple(versions.get(table, 0) for table in tables)
+
+def versioned(orders_tables=(), product_tables=()):
+    """Answer conditional GETs for a read route from table version counters.
+
+    The ETag covers the route, its query string and the versions of the
+    tables it reads, so a matching If-None-Match gets a 304 after two
+    primary-key lookups and without running the route's queries.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            versions = read_table_versions(db.session, orders_tables) if orders_tables else ()
+            if product_tables:
+                with get_product_db() as product_db:
+                    versions += read_table_versions(product_db, product_tables)
+            etag = hashlib.sha1(repr((request.full_path, versions)).encode()).hexdigest()
+
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            # Clients may keep the body but must revalidate before using it
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+@app.route('/stock/summary', methods=['GET'])
+@versioned(product_tables=('products',))
+def summarize_stock():
+    # Per package and warehouse, from the rollup the products triggers maintain
+    with get_product_db() as product_db:
+        grouped_results = product_db.execute(text(
+            "SELECT package_barcode, warehouse, total_amount, item_count FROM stock_package_rollups "
+            "ORDER BY package_barcode, warehouse"
+        )).all()
 
     # Build group list
     group_summary = []
@@ -158,20 +353,13 @@ def summarize_stock():
     })
 
 @app.route('/stock/warehouse_summary', methods=['GET'])
+@versioned(product_tables=('products',))
 def summarize_stock_by_warehouse():
-    product_db = next(get_product_db())
-
-    # Group by warehouse only
-    results = (
-        product_db.query(
-            Product.warehouse,
-            func.count(Product.barcode).label('item_count'),
-            func.sum(Product.amount).label('total_amount')
-        )
-        .filter(Product.in_stock == True)
-        .group_by(Product.warehouse)
-        .all()
-    )
+    # Per warehouse, from the rollup the products triggers maintain
+    with get_product_db() as product_db:
+        results = product_db.execute(text(
+            "SELECT warehouse, item_count, total_amount FROM stock_warehouse_rollups ORDER BY warehouse"
+        )).all()
 
     summary = []
     for warehouse, item_count, total_amount in results:
@@ -183,133 +371,793 @@ def summarize_stock_by_warehouse():
 
     return jsonify(summary)
 
+@app.cli.command('rebuild-stock-rollups')
+def rebuild_stock_rollups_command():
+    """Recompute the stock summary rollups from products."""
+    with get_product_db() as product_db:
+        for step in STOCK_ROLLUP_REBUILD:
+            product_db.execute(text(step))
+        bump_table_versions(product_db, 'products')
+        product_db.commit()
+        groups = product_db.execute(text("SELECT COUNT(*) FROM stock_package_rollups")).scalar()
+    print(f"Rebuilt stock rollups for {groups} package/warehouse groups.")
+
+def _done_text(flag):
+    return "OK" if flag == True else "Yapılmadı"
+
+# Export column mapping shared by every /export/orders format:
+# (header, value getter on a joined order/client row, column type)
+EXPORT_COLUMNS = [
+    ("Sipariş Id", lambda r: r.id, 'string'),
+    ("İsim", lambda r: r.name, 'string'),
+    ("Telefon", lambda r: r.phone_number, 'string'),
+    ("Bölge", lambda r: r.district, 'string'),
+    ("TC", lambda r: r.tc, 'string'),
+    ("Doğum Tarihi", lambda r: r.birthday, 'string'),
+    ("Adres", lambda r: r.address, 'string'),
+    ("Email", lambda r: r.email, 'string'),
+    ("Miktar", lambda r: r.quantity, 'float'),
+    ("Fatura", lambda r: _done_text(r.is_receipt_done), 'string'),
+    ("GTS", lambda r: _done_text(r.is_gts_done), 'string'),
+    ("GTS Barcode", lambda r: r.gts_barcode, 'string'),
+    ("Miktar Yazısı", lambda r: r.quantity_text, 'string'),
+    # Integer columns, but SQLite keeps whatever was stored, floats included
+    ("Fiyat", lambda r: r.price, 'float'),
+    ("Toplam Ücret", lambda r: r.quantity * r.price if r.quantity is not None and r.price is not None else None, 'float'),
+    ("Kalan Miktar", lambda r: r.remaining_amount, 'float'),
+    ("Kaynak", lambda r: r.source, 'string'),
+    ("Sipariş Tipi", lambda r: r.order_type, 'string'),
+    ("Ürün Tipi", lambda r: r.yield_type, 'string'),
+    ("Sipariş Tarihi", lambda r: r.purchase_date, 'string'),
+    ("Sipariş Durumu", lambda r: r.delivery_status, 'string'),
+]
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_MIMETYPES = {
+    'xlsx': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    'csv': "text/csv; charset=utf-8",
+    'parquet': "application/vnd.apache.parquet",
+}
+
+def iter_export_chunks():
+    # One joined query read EXPORT_CHUNK_SIZE rows at a time; plain column rows
+    # keep the session identity map empty so memory stays flat
+    stmt = (
+        select(
+            ClientOrder.id, ClientOrder.quantity, ClientOrder.quantity_text, ClientOrder.price,
+            ClientOrder.remaining_amount, ClientOrder.is_receipt_done, ClientOrder.is_gts_done,
+            ClientOrder.gts_barcode, ClientOrder.order_type, ClientOrder.yield_type,
+            ClientOrder.purchase_date, ClientOrder.delivery_status,
+            Client.name, Client.phone_number, Client.district, Client.tc, Client.birthday,
+            Client.address, Client.email, Client.source,
+        )
+        .join(Client, Client.id == ClientOrder.client_id)
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+    for partition in db.session.execute(stmt).partitions():
+        yield [[getter(row) for _, getter, _ in EXPORT_COLUMNS] for row in partition]
+
+def stream_csv_export():
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([header for header, _, _ in EXPORT_COLUMNS])
+    for chunk in iter_export_chunks():
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def write_xlsx_export(path):
+    # Write-only workbooks flush rows to disk instead of keeping cells in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Orders")
+    sheet.append([header for header, _, _ in EXPORT_COLUMNS])
+    for chunk in iter_export_chunks():
+        for row in chunk:
+            sheet.append(row)
+    workbook.save(path)
+
+def write_parquet_export(path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {'string': pa.string(), 'float': pa.float64(), 'int': pa.int64()}
+    schema = pa.schema([(header, arrow_types[kind]) for header, _, kind in EXPORT_COLUMNS])
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in iter_export_chunks():
+            # One row group per chunk
+            columns = [list(column) for column in zip(*chunk)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+def stream_file(f, chunk_size=64 * 1024):
+    # Streams an open export file; the caller closes it when the response is closed
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        yield data
+
 @app.route('/export/orders', methods=['GET'])
 def export_orders():
-    # Query all orders where is_receipt_done is False
-    # Collect only order data
-    data = [] 
+    # ?format=xlsx (default), csv or parquet
+    export_format = request.args.get('format', 'xlsx').lower()
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({'error': f"Unsupported format '{export_format}'"}), 400
+
+    export_file = None
+    if export_format == 'csv':
+        body = stream_with_context(stream_csv_export())
+    else:
+        # xlsx and parquet are written to a temporary file, then streamed from disk
+        fd, path = tempfile.mkstemp(suffix=f".{export_format}")
+        os.close(fd)
+        try:
+            if export_format == 'xlsx':
+                write_xlsx_export(path)
+            else:
+                write_parquet_export(path)
+            # Unlinked right away: the open handle keeps the data readable,
+            # and the disk space is freed when it is closed, whether or not
+            # the body was ever sent (HEAD, client gone before the first chunk)
+            export_file = open(path, 'rb')
+        finally:
+            os.remove(path)
+        body = stream_file(export_file)
+
+    response = Response(
+        body,
+        mimetype=EXPORT_MIMETYPES[export_format],
+        headers={'Content-Disposition': f'attachment; filename=orders.{export_format}'}
+    )
+    if export_file is not None:
+        response.call_on_close(export_file.close)
+    return response
+
+# Prometheus metrics per Flask endpoint: request count, latency, response
+# size, and the number and time of SQL statements each request ran against
+# both databases. Under gunicorn every worker writes its values to files in
+# PROMETHEUS_MULTIPROC_DIR (see gunicorn.conf.py) and /metrics adds them up.
+SQL_DATABASES = ('orders', 'products')
+
+if prometheus_client is not None:
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+    QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+
+    REQUEST_COUNT = prometheus_client.Counter(
+        'http_requests_total', 'Requests served', ['endpoint', 'method', 'status'])
+    REQUEST_LATENCY = prometheus_client.Histogram(
+        'http_request_duration_seconds', 'Time to build the response', ['endpoint', 'method'],
+        buckets=LATENCY_BUCKETS)
+    RESPONSE_SIZE = prometheus_client.Histogram(
+        'http_response_size_bytes', 'Response body size as sent (after compression); streamed responses are not counted',
+        ['endpoint'], buckets=SIZE_BUCKETS)
+    REQUEST_QUERIES = prometheus_client.Histogram(
+        'http_request_sql_queries', 'SQL statements run per request', ['endpoint', 'database'],
+        buckets=QUERY_COUNT_BUCKETS)
+    REQUEST_QUERY_TIME = prometheus_client.Histogram(
+        'http_request_sql_duration_seconds', 'Time spent in SQL per request', ['endpoint', 'database'],
+        buckets=LATENCY_BUCKETS)
+    SQL_QUERIES = prometheus_client.Counter(
+        'sql_queries_total', 'SQL statements run, including background jobs', ['database'])
+
+def metrics_endpoint():
+    # Route function name; requests that match no route share one label
+    return request.endpoint or 'unmatched'
+
+def track_queries(engine, database):
+    # Counts each statement run on engine into the current request's totals
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        if prometheus_client is not None:
+            SQL_QUERIES.labels(database).inc()
+        if has_request_context() and 'sql_stats' in g:
+            stats = g.sql_stats[database]
+            stats[0] += 1
+            stats[1] += elapsed
+            if 'sql_profile' in g:
+                profile_statement(cursor, database, statement, parameters, executemany, elapsed)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+        if started:
+            started.pop()
 
-    db_orders = ClientOrder.query.all()
-    orders = []
-    clients = []
-
-    for order in db_orders:
-        client = Client.query.get(order.client_id)
-        if client: 
-            gts_text = "Yapılmadı"
-            if order.is_gts_done == True:
-                gts_text = "OK"
-
-            receipt_text = "Yapılmadı"
-            if order.is_receipt_done == True:
-                receipt_text = "OK"
-
-            data.append({
-            "Sipariş Id": order.id,
-            "İsim": client.name,
-            "Telefon": client.phone_number,
-            "Bölge": client.district,
-            "TC": client.tc,
-            "Doğum Tarihi": client.birthday,
-            "Adres": client.address,
-            "Email": client.email,
-            "Miktar": order.quantity,
-            "Fatura": receipt_text,
-            "GTS": gts_text,
-            "GTS Barcode": order.gts_barcode,
-            "Miktar Yazısı": order.quantity_text,
-            "Fiyat": order.price,
-            "Toplam Ücret": order.quantity * order.price,
-            "Kalan Miktar": order.remaining_amount,
-            "Kaynak": client.source,
-            "Sipariş Tipi": order.order_type,
-            "Ürün Tipi": order.yield_type,
-            "Sipariş Tarihi": order.purchase_date,
-            "Sipariş Durumu": order.delivery_status,
+with app.app_context():
+    track_queries(db.engine, 'orders')
+track_queries(product_engine, 'products')
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    # database -> [statements, seconds]
+    g.sql_stats = {database: [0, 0.0] for database in SQL_DATABASES}
+
+# Registered before compress_response, so it runs after it and sees the
+# compressed size
+@app.after_request
+def record_request_metrics(response):
+    if prometheus_client is None or 'request_started' not in g:
+        return response
+    endpoint = metrics_endpoint()
+    REQUEST_COUNT.labels(endpoint, request.method, response.status_code).inc()
+    REQUEST_LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - g.request_started)
+    if not response.is_streamed and response.content_length is not None:
+        RESPONSE_SIZE.labels(endpoint).observe(response.content_length)
+    for database, (count, seconds) in g.sql_stats.items():
+        REQUEST_QUERIES.labels(endpoint, database).observe(count)
+        REQUEST_QUERY_TIME.labels(endpoint, database).observe(seconds)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if prometheus_client is None:
+        return jsonify({'error': 'prometheus_client is not installed'}), 501
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry), content_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+# SQL profiler. While it is on, every request's statements are recorded with
+# their timings, statements slower than slow_ms get their EXPLAIN QUERY PLAN,
+# and statements run more than once in a request are flagged (the N+1 loops).
+# Each profile is logged as one JSON line on the "sql_profile" logger and
+# kept in instance/profiles for /debug/profile/<request_id>; the response
+# carries the id in X-Request-ID.
+#
+# SQL_PROFILE=1 turns it on at start. POST /debug/profiling switches it at
+# runtime by writing instance/sql_profiling.json, which every worker
+# re-reads when it changes. The /debug routes need the X-Admin-Token header
+# to match PROFILER_ADMIN_TOKEN and are off when that isn't set.
+PROFILER_ADMIN_TOKEN = os.environ.get('PROFILER_ADMIN_TOKEN')
+PROFILER_DEFAULTS = {
+    'enabled': os.environ.get('SQL_PROFILE', '0').lower() in ('1', 'true', 'yes'),
+    'slow_ms': float(os.environ.get('SQL_PROFILE_SLOW_MS', 100)),
+}
+PROFILE_KEEP = int(os.environ.get('SQL_PROFILE_KEEP', 200))
+# The profiles directory is trimmed back to PROFILE_KEEP every this many
+# saves per worker, not on every profiled request
+PROFILE_TRIM_EVERY = int(os.environ.get('SQL_PROFILE_TRIM_EVERY', 50))
+PROFILE_DIR = os.path.join(app.instance_path, 'profiles')
+PROFILER_SETTINGS_PATH = os.path.join(app.instance_path, 'sql_profiling.json')
+# Longest parameter text kept per statement
+PROFILE_PARAMS_MAX = 500
+
+profile_logger = logging.getLogger('sql_profile')
+if not profile_logger.handlers:
+    profile_handler = logging.StreamHandler()
+    profile_handler.setFormatter(logging.Formatter('%(message)s'))
+    profile_logger.addHandler(profile_handler)
+    profile_logger.setLevel(logging.INFO)
+    profile_logger.propagate = False
+
+_profiler_settings = {'mtime': None, 'settings': PROFILER_DEFAULTS}
+
+def profiler_settings():
+    # The switch file's settings when there is one, else the env defaults
+    try:
+        mtime = os.stat(PROFILER_SETTINGS_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return PROFILER_DEFAULTS
+    if mtime != _profiler_settings['mtime']:
+        try:
+            with open(PROFILER_SETTINGS_PATH) as f:
+                settings = {**PROFILER_DEFAULTS, **json.load(f)}
+        except ValueError:
+            settings = PROFILER_DEFAULTS
+        _profiler_settings.update(mtime=mtime, settings=settings)
+    return _profiler_settings['settings']
+
+def explain_query_plan(cursor, statement, parameters, executemany):
+    # On a separate cursor of the same connection, so the statement's own
+    # results are untouched; EXPLAIN doesn't run the statement
+    if executemany:
+        parameters = parameters[0] if parameters else ()
+    try:
+        rows = cursor.connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters or ()).fetchall()
+    except sqlite3.Error as e:
+        return [f"unavailable: {e}"]
+    return [row[3] for row in rows]
+
+def profile_statement(cursor, database, statement, parameters, executemany, elapsed):
+    duration_ms = elapsed * 1000
+    entry = {
+        'database': database,
+        'statement': statement,
+        'parameters': repr(parameters)[:PROFILE_PARAMS_MAX],
+        'executemany': executemany,
+        'duration_ms': round(duration_ms, 3),
+    }
+    if duration_ms >= g.sql_profile['slow_ms']:
+        entry['query_plan'] = explain_query_plan(cursor, statement, parameters, executemany)
+    g.sql_profile['statements'].append(entry)
+
+def repeated_statements(statements):
+    # Statements run more than once in the request, most repeated first
+    groups = OrderedDict()
+    for entry in statements:
+        group = groups.setdefault((entry['database'], entry['statement']), {
+            'database': entry['database'],
+            'statement': entry['statement'],
+            'count': 0,
+            'total_ms': 0.0,
+            'parameter_sets': set(),
         })
+        group['count'] += 1
+        group['total_ms'] += entry['duration_ms']
+        group['parameter_sets'].add(entry['parameters'])
+
+    repeated = []
+    for group in groups.values():
+        if group['count'] > 1:
+            # identical: same statement with the same parameters every time
+            group['identical'] = len(group['parameter_sets']) == 1
+            group['parameter_sets'] = len(group['parameter_sets'])
+            group['total_ms'] = round(group['total_ms'], 3)
+            repeated.append(group)
+    return sorted(repeated, key=lambda group: group['count'], reverse=True)
+
+def profile_path(request_id):
+    return os.path.join(PROFILE_DIR, f"{request_id}.json")
+
+def new_request_id():
+    # Starts with the time, so ids sort in the order the requests were made
+    return f"{time.time_ns():016x}{uuid.uuid4().hex[:12]}"
+
+def saved_profile_ids():
+    # Oldest first
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    return sorted(name[:-len('.json')] for name in os.listdir(PROFILE_DIR) if name.endswith('.json'))
+
+_profile_saves = {'count': 0}
+_profile_saves_lock = threading.Lock()
+
+def save_profile(profile):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = profile_path(profile['request_id'])
+    with open(f"{path}.partial", 'w') as f:
+        json.dump(profile, f)
+    os.replace(f"{path}.partial", path)
+
+    with _profile_saves_lock:
+        _profile_saves['count'] += 1
+        if _profile_saves['count'] % PROFILE_TRIM_EVERY:
+            return
+
+    # Keep the newest PROFILE_KEEP profiles
+    request_ids = saved_profile_ids()
+    for request_id in request_ids[:max(len(request_ids) - PROFILE_KEEP, 0)]:
+        try:
+            os.remove(profile_path(request_id))
+        except FileNotFoundError:
+            # Another worker trimmed it first
+            pass
+
+@app.before_request
+def start_sql_profile():
+    if request.path.startswith('/debug/'):
+        return
+    settings = profiler_settings()
+    if settings['enabled']:
+        g.sql_profile = {
+            'request_id': new_request_id(),
+            'slow_ms': settings['slow_ms'],
+            'started_at': datetime.now().isoformat(timespec='milliseconds'),
+            'statements': [],
+        }
 
-    # Create a pandas DataFrame
-    df = pd.DataFrame(data)
-
-    # Save DataFrame to an Excel file in memory
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name="Orders")
-
-    output.seek(0)
-
-    # Return the file
-    return send_file(
-        output,
-        download_name="orders.xlsx",
-        as_attachment=True,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Registered after record_request_metrics, so it runs first and the latency
+# metric includes the profiler's own overhead
+@app.after_request
+def finish_sql_profile(response):
+    if 'sql_profile' not in g:
+        return response
+    profile = g.pop('sql_profile')
+    statements = profile.pop('statements')
+    profile.update({
+        'method': request.method,
+        'path': request.full_path if request.query_string else request.path,
+        'endpoint': metrics_endpoint(),
+        'status': response.status_code,
+        'duration_ms': round((time.perf_counter() - g.request_started) * 1000, 3),
+        'statement_count': len(statements),
+        'sql_ms': round(sum(entry['duration_ms'] for entry in statements), 3),
+        'slow_statements': sum(1 for entry in statements if 'query_plan' in entry),
+        'repeated': repeated_statements(statements),
+        'statements': statements,
+    })
+    try:
+        save_profile(profile)
+    except OSError as e:
+        profile_logger.warning(json.dumps({'event': 'sql_profile_not_saved', 'error': str(e)}))
+    profile_logger.info(json.dumps({'event': 'sql_profile', **profile}))
+    response.headers['X-Request-ID'] = profile['request_id']
+    return response
+
+def require_admin_token():
+    # 404 rather than 403 when no token is configured: the routes don't exist
+    if not PROFILER_ADMIN_TOKEN:
+        abort(404)
+    token = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(token.encode(), PROFILER_ADMIN_TOKEN.encode()):
+        abort(403)
+
+@app.route('/debug/profiling', methods=['GET', 'POST'])
+def profiling_settings():
+    # POST {"enabled": true, "slow_ms": 50} switches the profiler in every worker
+    require_admin_token()
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        settings = dict(profiler_settings())
+        if 'enabled' in data:
+            if not isinstance(data['enabled'], bool):
+                return jsonify({'error': 'enabled must be true or false'}), 400
+            settings['enabled'] = data['enabled']
+        if 'slow_ms' in data:
+            if isinstance(data['slow_ms'], bool) or not isinstance(data['slow_ms'], (int, float)) or data['slow_ms'] < 0:
+                return jsonify({'error': 'slow_ms must be a number >= 0'}), 400
+            settings['slow_ms'] = data['slow_ms']
+        with open(f"{PROFILER_SETTINGS_PATH}.partial", 'w') as f:
+            json.dump(settings, f)
+        os.replace(f"{PROFILER_SETTINGS_PATH}.partial", PROFILER_SETTINGS_PATH)
+
+    return jsonify({**profiler_settings(), 'recent': saved_profile_ids()[::-1][:20]})
+
+@app.route('/debug/profile/<request_id>', methods=['GET'])
+def get_profile(request_id):
+    require_admin_token()
+    # new_request_id() ids only; anything else can't name a file in PROFILE_DIR
+    if not re.fullmatch(r"[0-9a-f]{28}", request_id):
+        return jsonify({'error': 'Invalid request id'}), 400
+    if not os.path.exists(profile_path(request_id)):
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(profile_path(request_id), mimetype='application/json', max_age=0)
+
+# Response compression. JSON bodies above COMPRESS_MIN_SIZE are encoded
+# with the best encoding the client accepts; on equal preference brotli wins
+# over zstd over gzip. Levels favour speed since bodies are compressed per
+# request.
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_MIMETYPES = {'application/json', 'text/csv', 'text/plain', 'text/html'}
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_LEVEL = int(os.environ.get('COMPRESS_BROTLI_LEVEL', 4))
+COMPRESS_ZSTD_LEVEL = int(os.environ.get('COMPRESS_ZSTD_LEVEL', 3))
+
+COMPRESSORS = OrderedDict()
+if brotli is not None:
+    COMPRESSORS['br'] = lambda data: brotli.compress(data, quality=COMPRESS_BROTLI_LEVEL)
+if zstandard is not None:
+    COMPRESSORS['zstd'] = lambda data: zstandard.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL).compress(data)
+COMPRESSORS['gzip'] = lambda data: gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+
+class CompressedBodyCache:
+    # LRU of compressed bodies keyed by (ETag, encoding), bounded by total
+    # size. The ETag changes with every write to the tables behind a route,
+    # so entries never go stale; they just stop being asked for.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+compressed_body_cache = CompressedBodyCache(
+    max_bytes=int(os.environ.get('COMPRESS_CACHE_BYTES', 32 * 1024 * 1024)),
+)
+
+@app.after_request
+def compress_response(response):
+    if response.status_code == 304:
+        response.vary.add('Accept-Encoding')
+        return response
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if response.content_length is None or response.content_length < COMPRESS_MIN_SIZE:
+        return response
+    encoding = request.accept_encodings.best_match(list(COMPRESSORS))
+    if encoding is None:
+        return response
+
+    # Only responses with an ETag (see versioned) are cached: the tag pins
+    # the exact body, so repeat polls skip the compression entirely
+    etag, _ = response.get_etag()
+    key = (etag, encoding) if etag else None
+    body = compressed_body_cache.get(key) if key else None
+    if body is None:
+        body = COMPRESSORS[encoding](response.get_data())
+        if key:
+            compressed_body_cache.put(key, body)
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# Response key -> column for the list endpoints; ?fields= picks a subset
+ORDER_FIELDS = {
+    'id': Order.id,
+    'name': Order.name,
+    'phoneNumber': Order.phone_number,
+    'district': Order.district,
+    'price': Order.price,
+    'quantity': Order.quantity,
+    'quantityText': Order.quantity_text,
+    'remainingAmount': Order.remaining_amount,
+    'address': Order.address,
+    'email': Order.email,
+    'cargoBarcode': Order.cargo_barcode,
+    'gtsBarcode': Order.gts_barcode,
+    'tc': Order.tc,
+    'birthday': Order.birthday,
+    'isReceiptDone': Order.is_receipt_done,
+    'isGTSDone': Order.is_gts_done,
+    'source': Order.source,
+    'lastUpdate': Order.last_update,
+    'orderType': Order.order_type,
+    'activityLogId': Order.activity_log_id,
+    'purchaseDate': Order.purchase_date,
+    'comments': Order.comments,
+    'deliveryStatus': Order.delivery_status,
+}
+
+CLIENT_FIELDS = {
+    'id': Client.id,
+    'name': Client.name,
+    'phoneNumber': Client.phone_number,
+    'district': Client.district,
+    'address': Client.address,
+    'tc': Client.tc,
+    'birthday': Client.birthday,
+    'source': Client.source,
+    'comments': Client.comments,
+    'email': Client.email,
+    'title': Client.title,
+    'gtsNumber': Client.gts_number,
+}
+
+CLIENT_ORDER_FIELDS = {
+    'id': ClientOrder.id,
+    'clientId': ClientOrder.client_id,
+    'quantity': ClientOrder.quantity,
+    'quantityText': ClientOrder.quantity_text,
+    'price': ClientOrder.price,
+    'remainingAmount': ClientOrder.remaining_amount,
+    'isReceiptDone': ClientOrder.is_receipt_done,
+    'isGTSDone': ClientOrder.is_gts_done,
+    'cargoBarcode': ClientOrder.cargo_barcode,
+    'gtsBarcode': ClientOrder.gts_barcode,
+    'orderType': ClientOrder.order_type,
+    'lastUpdate': ClientOrder.last_update,
+    'purchaseDate': ClientOrder.purchase_date,
+    'comments': ClientOrder.comments,
+    'deliveryStatus': ClientOrder.delivery_status,
+    'yieldType': ClientOrder.yield_type,
+    'intermediarId': ClientOrder.intermediar_id,
+    'intermediarAmount': ClientOrder.intermediar_amount,
+    'productType': ClientOrder.product_type,
+}
+
+PAYMENT_FIELDS = {
+    'id': PaymentLog.id,
+    'order_id': PaymentLog.order_id,
+    'amount': PaymentLog.amount,
+    'payment_date': PaymentLog.payment_date,
+    'method': PaymentLog.method,
+    'note': PaymentLog.note,
+}
+
+# /api/get_order has never sent the id or lastUpdate back
+ORDER_DETAIL_FIELDS = {key: column for key, column in ORDER_FIELDS.items() if key not in ('id', 'lastUpdate')}
+
+# /orders/unpaid has always spelled it isGtsDone
+UNPAID_ORDER_FIELDS = {
+    ('isGtsDone' if key == 'isGTSDone' else key): column for key, column in CLIENT_ORDER_FIELDS.items()
+}
+
+def field_columns(field_groups):
+    return [column for group in field_groups for column in group.values()]
+
+def split_fields(row, offset, field_groups):
+    # One {key: value} dict per field group, read from a Core row whose
+    # field columns start at offset
+    groups = []
+    for group in field_groups:
+        groups.append(dict(zip(group, row[offset:offset + len(group)])))
+        offset += len(group)
+    return groups
+
+class ListQueryError(ValueError):
+    pass
+
+def parse_bool_arg(value):
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise ListQueryError(f"'{value}' is not a boolean")
+
+# Query-string filters shared by the list endpoints: column name -> value parser
+LIST_FILTERS = {
+    'delivery_status': str,
+    'order_type': str,
+    'is_gts_done': parse_bool_arg,
+    'is_receipt_done': parse_bool_arg,
+}
+
+def requested_fields(field_table, param='fields'):
+    # ?fields=id,name,... -> the matching subset of field_table, in that order
+    requested = request.args.get(param)
+    if not requested:
+        return dict(field_table)
+    names = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in names if name not in field_table]
+    if unknown:
+        raise ListQueryError(f"Unknown {param}: {', '.join(unknown)}")
+    return {name: field_table[name] for name in names}
+
+def list_filters(model):
+    conditions = []
+    for name, parse in LIST_FILTERS.items():
+        value = request.args.get(name)
+        if value is None:
+            continue
+        if name not in model.__table__.columns:
+            raise ListQueryError(f"Filter '{name}' is not supported here")
+        conditions.append(model.__table__.columns[name] == parse(value))
+    return conditions
+
+def run_list_query(model, field_groups, cursor_column, extra_columns=(), join=None, where=()):
+    """Run a list endpoint's query from the request's fields, filters and pagination.
+
+    Only the columns in ``field_groups`` (a list of {key: column} dicts) and
+    ``extra_columns`` are selected. ?after=<cursor>&limit=<n> pages by
+    ``cursor_column``. Returns (rows, next_after, paginated) where each row is
+    (tuple of extra column values, one dict per field group).
+    """
+    after = request.args.get('after')
+    limit = request.args.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or int(limit) <= 0:
+            raise ListQueryError('limit must be a positive integer')
+        limit = int(limit)
+
+    stmt = select(cursor_column.label('_cursor'), *extra_columns, *field_columns(field_groups))
+    if join is not None:
+        stmt = stmt.join(*join)
+    stmt = stmt.where(*where, *list_filters(model))
+
+    paginated = after is not None or limit is not None
+    if paginated:
+        stmt = stmt.order_by(cursor_column)
+        if after is not None:
+            stmt = stmt.where(cursor_column > after)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+
+    rows = []
+    result = db.session.execute(stmt).all()
+    for row in result:
+        offset = 1 + len(extra_columns)
+        rows.append((tuple(row[1:offset]), *split_fields(row, offset, field_groups)))
+
+    full_page = limit is not None and len(result) == limit
+    next_after = result[-1][0] if full_page else None
+    return rows, next_after, paginated
+
+def list_response(payload, next_after, paginated):
+    # Bare-list endpoints carry the next cursor in a header
+    response = jsonify(payload)
+    if paginated and next_after is not None:
+        response.headers['X-Next-After'] = next_after
+    return response
+
+@app.errorhandler(ListQueryError)
+def handle_list_query_error(e):
+    return jsonify({'error': str(e)}), 400
+
+def add_to_order_balance(order_id, amount):
+    # Adds amount (negative to reverse a payment) to the order's paid total.
+    # Runs in the caller's session so it commits together with the payment.
+    add_to_order_balances({order_id: amount})
+
+def add_to_order_balances(amounts):
+    # add_to_order_balance for many orders ({order_id: amount}) in one statement
+    stmt = sqlite_insert(OrderBalance)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[OrderBalance.order_id],
+        set_={'paid_amount': OrderBalance.paid_amount + stmt.excluded.paid_amount}
+    )
+    db.session.execute(stmt, [{'order_id': order_id, 'paid_amount': amount} for order_id, amount in amounts.items()])
+
+def subtract_from_remaining_amounts(amounts):
+    # remaining_amount -= amount per order ({order_id: amount}), computed by
+    # SQLite so concurrent payments on one order can't overwrite each other
+    order_table = ClientOrder.__table__
+    db.session.execute(
+        update(order_table)
+        .where(order_table.c.id == bindparam('b_order_id'))
+        .values(remaining_amount=func.coalesce(order_table.c.remaining_amount, 0) - bindparam('b_amount')),
+        [{'b_order_id': order_id, 'b_amount': amount} for order_id, amount in amounts.items()]
     )
 
-def serialize_order(order):
-    return {
-        "id": order.id,
-        "clientId": order.client_id,
-        "quantity": order.quantity,
-        "quantityText": order.quantity_text,
-        "price": order.price,
-        "remainingAmount": order.remaining_amount,
-        "isReceiptDone": order.is_receipt_done,
-        "isGtsDone": order.is_gts_done,
-        "cargoBarcode": order.cargo_barcode,
-        "gtsBarcode": order.gts_barcode,
-        "orderType": order.order_type,
-        "lastUpdate": order.last_update,
-        "purchaseDate": order.purchase_date,
-        "comments": order.comments,
-        "deliveryStatus": order.delivery_status,
-        "yieldType": order.yield_type,
-        "intermediarId": order.intermediar_id,
-        "intermediarAmount": order.intermediar_amount,
-        "productType": order.product_type
-    }
+def rebuild_order_balances():
+    # Recompute every paid total from PaymentLog with a single GROUP BY
+    db.session.execute(delete(OrderBalance))
+    result = db.session.execute(
+        insert(OrderBalance).from_select(
+            ['order_id', 'paid_amount'],
+            select(PaymentLog.order_id, func.sum(PaymentLog.amount)).group_by(PaymentLog.order_id)
+        )
+    )
+    bump_table_versions(db.session, 'payment_log')
+    db.session.commit()
+    return result.rowcount
 
-def serialize_client(client):
-    return {
-        "id": client.id,
-        "name": client.name,
-        "phoneNumber": client.phone_number,
-        "district": client.district,
-        "address": client.address,
-        "tc": client.tc,
-        "birthday": client.birthday,
-        "source": client.source,
-        "comments": client.comments,
-        "email": client.email,
-        "title": client.title,
-        "gtsNumber": client.gts_number
-    }
+@app.cli.command('rebuild-order-balances')
+def rebuild_order_balances_command():
+    """Recompute the order balance ledger from PaymentLog."""
+    count = rebuild_order_balances()
+    print(f"Rebuilt paid totals for {count} orders.")
 
 @app.route('/orders/unpaid', methods=['GET'])
+@versioned(orders_tables=('client_order', 'client', 'payment_log'))
 def get_unpaid_orders():
-    orders = db.session.query(ClientOrder).all()
-    response = []
-
-    for order in orders:
-        # Ensure price and quantity are valid
-        if order.price is None or order.quantity is None:
-            continue
-
-        total_amount = order.price * order.quantity
-
-        paid_amount = db.session.query(
-            func.coalesce(func.sum(PaymentLog.amount), 0)
-        ).filter(PaymentLog.order_id == order.id).scalar()
-
-        remaining_amount = total_amount - paid_amount
+    # ?remaining_only=true drops orders that are fully paid
+    remaining_only = request.args.get('remaining_only', 'false').lower() == 'true'
+
+    total_amount = ClientOrder.price * ClientOrder.quantity
+    paid_amount = func.coalesce(OrderBalance.paid_amount, 0)
+
+    field_groups = [UNPAID_ORDER_FIELDS, CLIENT_FIELDS]
+    stmt = (
+        select(Client.id, paid_amount, total_amount - paid_amount, *field_columns(field_groups))
+        .select_from(ClientOrder)
+        .outerjoin(Client, Client.id == ClientOrder.client_id)
+        .outerjoin(OrderBalance, OrderBalance.order_id == ClientOrder.id)
+        .where(ClientOrder.price.isnot(None), ClientOrder.quantity.isnot(None))
+    )
+    if remaining_only:
+        stmt = stmt.where(total_amount - paid_amount > 0)
 
-        # if remaining_amount > 0:
-        client = db.session.query(Client).filter(Client.id == order.client_id).first()
+    response = []
+    for row in db.session.execute(stmt):
+        client_id, paid, remaining = row[:3]
+        order, client = split_fields(row, 3, field_groups)
         response.append({
-            "order": serialize_order(order),
-            "client": serialize_client(client),
-            "paid_amount": paid_amount,
-            "remaining_amount": remaining_amount
+            "order": order,
+            "client": client if client_id is not None else None,
+            "paid_amount": paid,
+            "remaining_amount": remaining
         })
 
     return jsonify(response)
@@ -318,8 +1166,25 @@ def get_unpaid_orders():
 with app.app_context():
     db.create_all()
     ProductBase.metadata.create_all(bind=product_engine)
+    apply_migrations(db.engine, ORDERS_MIGRATIONS)
+    apply_migrations(product_engine, PRODUCTS_MIGRATIONS)
+
+    # First start with the ledger table: seed it from the existing payments
+    if db.session.query(OrderBalance.order_id).first() is None and db.session.query(PaymentLog.id).first() is not None:
+        rebuild_order_balances()
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations to both databases."""
+    for name, engine, migrations in (('orders', db.engine, ORDERS_MIGRATIONS),
+                                     ('products', product_engine, PRODUCTS_MIGRATIONS)):
+        for version, description in apply_migrations(engine, migrations):
+            print(f"{name}: applied {version} - {description}")
+        with engine.connect() as connection:
+            print(f"{name}: schema version {schema_version(connection)}")
 
 # Function to get a session for the product database
+@contextmanager
 def get_product_db():
     db = ProductSessionLocal()
     try:
@@ -346,6 +1211,8 @@ def save_client():
         gts_number=data.get('gtsNumber')
     )
     db.session.add(new_client)
+    bump_table_versions(db.session, 'client')
+    record_changes(db.session, [{'entity': 'client', 'id': new_client.id, 'op': 'create'}])
     db.session.commit()
     return jsonify({"message": "Client added successfully!"}), 200
 
@@ -363,6 +1230,8 @@ def update_client(client_id):
         if hasattr(client, key):  # Check if the attribute exists
             setattr(client, key, value)  # Set the attribute to the new value
 
+    bump_table_versions(db.session, 'client')
+    record_changes(db.session, [{'entity': 'client', 'id': client_id, 'fields': field_keys(CLIENT_FIELDS, data)}])
     db.session.commit()
     return jsonify({"message": "Client updated successfully!"}), 200
 
@@ -374,26 +1243,16 @@ def delete_client(client_id):
         return jsonify({"message": "Client not found!"}), 404
 
     db.session.delete(client)
+    bump_table_versions(db.session, 'client')
+    record_changes(db.session, [{'entity': 'client', 'id': client_id, 'op': 'delete'}])
     db.session.commit()
     return jsonify({"message": "Client deleted successfully!"}), 200
 
 @app.route('/api/get_clients', methods=['GET'])
+@versioned(orders_tables=('client',))
 def get_clients():
-    clients = Client.query.all()  # Fetch all orders from the database
-    return jsonify([{
-        'id': client.id,
-        'name': client.name,
-        'phoneNumber': client.phone_number,
-        'district': client.district,
-        'address': client.address,
-        'email': client.email,
-        'tc': client.tc,
-        'birthday': client.birthday,
-        'source': client.source,
-        'comments': client.comments,
-        'title': client.title,
-        'gtsNumber': client.gts_number
-    } for client in clients])
+    rows, next_after, paginated = run_list_query(Client, [requested_fields(CLIENT_FIELDS)], Client.id)
+    return list_response([client for _, client in rows], next_after, paginated)
 
 @app.route('/api/save_client_order', methods=['POST'])
 def save_client_order():
@@ -421,6 +1280,8 @@ def save_client_order():
     )
     
     db.session.add(new_order)
+    bump_table_versions(db.session, 'client_order')
+    record_changes(db.session, [{'entity': 'client_order', 'id': new_order.id, 'op': 'create'}])
     db.session.commit()
     
     return jsonify({'message': 'Client order saved successfully!'}), 200
@@ -439,6 +1300,8 @@ def update_client_order(order_id):
         if hasattr(order, key):  # Check if the attribute exists
             setattr(order, key, value)  # Set the attribute to the new value
 
+    bump_table_versions(db.session, 'client_order')
+    record_changes(db.session, [{'entity': 'client_order', 'id': order_id, 'fields': field_keys(CLIENT_ORDER_FIELDS, data)}])
     db.session.commit()
     return jsonify({"message": "ClientOrder updated successfully!"}), 200
 
@@ -450,88 +1313,151 @@ def delete_client_order(client_id):
         return jsonify({"message": "Client Order not found!"}), 404
 
     db.session.delete(order)
+    bump_table_versions(db.session, 'client_order')
+    record_changes(db.session, [{'entity': 'client_order', 'id': client_id, 'op': 'delete'}])
     db.session.commit()
     return jsonify({"message": "Client deleted successfully!"}), 200
 
 @app.route('/api/get_client_orders', methods=['GET'])
+@versioned(orders_tables=('client_order', 'client'))
 def get_client_orders():
-    db_orders = ClientOrder.query.all()
+    # ?after=<order id>&limit=<n> pages through orders by id.
+    # ?fields= / ?client_fields= pick the order and client keys to return.
+    # ?shape=grouped returns every client once, keyed by id, instead of the
+    # legacy parallel 'orders'/'clients' lists.
+    shape = request.args.get('shape', 'legacy')
+    if shape not in ('legacy', 'grouped'):
+        return jsonify({'error': f"Unknown shape '{shape}'"}), 400
+
+    # Single joined query; orders without a matching client are skipped
+    rows, next_after, paginated = run_list_query(
+        ClientOrder,
+        [requested_fields(CLIENT_ORDER_FIELDS), requested_fields(CLIENT_FIELDS, 'client_fields')],
+        ClientOrder.id,
+        extra_columns=[Client.id.label('_client_id')],
+        join=(Client, Client.id == ClientOrder.client_id),
+    )
+
     orders = []
-    clients = []
-
-    for order in db_orders:
-        client = Client.query.get(order.client_id)
-        if client:
-            orders.append({
-                    "id": order.id,
-                    "clientId": order.client_id,
-                    "quantity": order.quantity,
-                    "quantityText": order.quantity_text,
-                    "price": order.price,
-                    "remainingAmount": order.remaining_amount,
-                    "isReceiptDone": order.is_receipt_done,
-                    "isGTSDone": order.is_gts_done,
-                    "cargoBarcode": order.cargo_barcode,
-                    "gtsBarcode": order.gts_barcode,
-                    "orderType": order.order_type,
-                    "lastUpdate": order.last_update,
-                    "purchaseDate": order.purchase_date,
-                    "comments": order.comments,
-                    "deliveryStatus": order.delivery_status,
-                    "yieldType": order.yield_type,
-                    "intermediarId": order.intermediar_id,
-                    "intermediarAmount": order.intermediar_amount,
-                    "productType": order.product_type,
-                })
-            clients.append({
-                    "id": client.id,
-                    "name": client.name,
-                    "phoneNumber": client.phone_number,
-                    "district": client.district,
-                    "address": client.address,
-                    "tc": client.tc,
-                    "birthday": client.birthday,
-                    "source": client.source,
-                    "comments": client.comments,
-                    "email": client.email,
-                    "title": client.title,
-                    "gtsNumber": client.gts_number
-                })
+    clients = [] if shape == 'legacy' else {}
+    for (client_id,), order, client in rows:
+        orders.append(order)
+        if shape == 'legacy':
+            clients.append(client)
+        elif client_id not in clients:
+            clients[client_id] = client
+
+    response = {'orders': orders, 'clients': clients}
+    if paginated:
+        # Cursor for the next page, None once the last page has been served
+        response['next_after'] = next_after
 
-    return jsonify({'orders': orders, 'clients': clients}), 200
+    return jsonify(response), 200
 
 @app.route('/api/get_one_client_orders/<string:client_id>', methods=['GET'])
 def get_one_client_orders(client_id):
-    orders = ClientOrder.query.filter_by(client_id=client_id).all()
-    if not orders:
+    stmt = select(*CLIENT_ORDER_FIELDS.values()).where(ClientOrder.client_id == client_id)
+    orders_list = [dict(zip(CLIENT_ORDER_FIELDS, row)) for row in db.session.execute(stmt)]
+    if not orders_list:
         return jsonify({'message': 'No orders found for this client.'}), 404
 
-    orders_list = []
-    for order in orders:
-        orders_list.append({
-                    "id": order.id,
-                    "clientId": order.client_id,
-                    "quantity": order.quantity,
-                    "quantityText": order.quantity_text,
-                    "price": order.price,
-                    "remainingAmount": order.remaining_amount,
-                    "isReceiptDone": order.is_receipt_done,
-                    "isGTSDone": order.is_gts_done,
-                    "cargoBarcode": order.cargo_barcode,
-                    "gtsBarcode": order.gts_barcode,
-                    "orderType": order.order_type,
-                    "lastUpdate": order.last_update,
-                    "purchaseDate": order.purchase_date,
-                    "comments": order.comments,
-                    "deliveryStatus": order.delivery_status,
-                    "yieldType": order.yield_type,
-                    "intermediarId": order.intermediar_id,
-                    "intermediarAmount": order.intermediar_amount,
-                    "productType": order.product_type,
-                })
-
     return jsonify(orders_list), 200
 
+# Keys returned with each search hit
+SEARCH_CLIENT_FIELDS = {key: CLIENT_FIELDS[key] for key in ('id', 'name', 'phoneNumber', 'district', 'tc', 'email')}
+SEARCH_ORDER_FIELDS = {key: CLIENT_ORDER_FIELDS[key] for key in (
+    'id', 'clientId', 'cargoBarcode', 'gtsBarcode', 'deliveryStatus', 'purchaseDate', 'comments'
+)}
+SEARCH_ENTITIES = ('client', 'client_order')
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+# bm25 column weights, in migrations.SEARCH_COLUMNS order:
+# name, phone, tc, place, email, codes, comments
+SEARCH_RANK = "bm25(search_index, 10.0, 8.0, 8.0, 2.0, 4.0, 8.0, 1.0)"
+
+def search_match_query(q):
+    # Every word of q as a quoted prefix term, all of which must match; quoting
+    # keeps FTS5 operators and punctuation in user input from being parsed.
+    # Dotless/dotted i are folded as in the index (migrations.turkish_fold_sql).
+    words = re.findall(r"\w+", q.replace('ı', 'i').replace('İ', 'i'))
+    return " ".join(f'"{word}"*' for word in words)
+
+def parse_search_int(name, default, minimum):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    if not value.isdigit() or int(value) < minimum:
+        raise ListQueryError(f"{name} must be an integer >= {minimum}")
+    return int(value)
+
+# Ranked type-ahead search over clients and client orders:
+# ?q=<words> (each word matches as a prefix), ?entity=client|client_order,
+# ?limit=<n>&offset=<n> pages through the ranked hits
+@app.route('/api/search', methods=['GET'])
+@versioned(orders_tables=('client', 'client_order'))
+def search():
+    match = search_match_query(request.args.get('q', ''))
+    if not match:
+        return jsonify({'error': 'q must contain at least one letter or digit'}), 400
+    entity = request.args.get('entity')
+    if entity is not None and entity not in SEARCH_ENTITIES:
+        return jsonify({'error': f"Unknown entity '{entity}'"}), 400
+    limit = min(parse_search_int('limit', SEARCH_DEFAULT_LIMIT, 1), SEARCH_MAX_LIMIT)
+    offset = parse_search_int('offset', 0, 0)
+
+    # One row past the page tells whether there is a next one
+    hits = db.session.execute(text(
+        f"SELECT d.entity, d.entity_id, {SEARCH_RANK} AS score "
+        "FROM search_index JOIN search_docs d ON d.doc_id = search_index.rowid "
+        "WHERE search_index MATCH :match AND (:entity IS NULL OR d.entity = :entity) "
+        "ORDER BY score, d.doc_id LIMIT :limit OFFSET :offset"
+    ), {'match': match, 'entity': entity, 'limit': limit + 1, 'offset': offset}).all()
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+
+    order_ids = [entity_id for kind, entity_id, _ in hits if kind == 'client_order']
+    orders = {}
+    for row in db.session.execute(select(*SEARCH_ORDER_FIELDS.values()).where(ClientOrder.id.in_(order_ids))):
+        order = dict(zip(SEARCH_ORDER_FIELDS, row))
+        orders[order['id']] = order
+
+    # Order hits come with their client, for the row's label
+    client_ids = {entity_id for kind, entity_id, _ in hits if kind == 'client'}
+    client_ids.update(order['clientId'] for order in orders.values())
+    clients = {}
+    for row in db.session.execute(select(*SEARCH_CLIENT_FIELDS.values()).where(Client.id.in_(client_ids))):
+        client = dict(zip(SEARCH_CLIENT_FIELDS, row))
+        clients[client['id']] = client
+
+    results = []
+    for kind, entity_id, score in hits:
+        if kind == 'client':
+            order, client_id = None, entity_id
+        else:
+            order = orders.get(entity_id)
+            client_id = order['clientId'] if order else None
+        results.append({
+            'entity': kind,
+            'id': entity_id,
+            'score': round(-score, 4),
+            'client': clients.get(client_id),
+            'order': order,
+        })
+
+    return jsonify({
+        'results': results,
+        'next_offset': offset + limit if has_more else None,
+    })
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Refill the client and order search index."""
+    for step in SEARCH_REBUILD:
+        db.session.execute(text(step))
+    db.session.commit()
+    count = db.session.execute(text("SELECT COUNT(*) FROM search_docs")).scalar()
+    print(f"Indexed {count} clients and client orders.")
+
 ##############################
 @app.route('/api/save_order', methods=['POST'])
 def save_order():
@@ -573,31 +1499,11 @@ def save_order():
 # Fetch order data by ID
 @app.route('/api/get_order/<string:order_id>', methods=['GET'])
 def get_order(order_id):
-    order = Order.query.get(order_id)
-    if order:
-        return jsonify({
-            'name': order.name,
-            'phoneNumber': order.phone_number,
-            'district': order.district,
-            'price': order.price,
-            'quantity': order.quantity,
-            'remainingAmount': order.remaining_amount,
-            'quantityText': order.quantity_text,
-            'address': order.address,
-            'email': order.email,
-            'cargoBarcode': order.cargo_barcode,
-            'gtsBarcode': order.gts_barcode,
-            'tc': order.tc,
-            'birthday': order.birthday,
-            'isReceiptDone': order.is_receipt_done,
-            'isGTSDone': order.is_gts_done,
-            'source': order.source,
-            'orderType': order.order_type,
-            'activityLogId': order.activity_log_id,
-            'purchaseDate': order.purchase_date,
-            'comments': order.comments,
-            'deliveryStatus': order.delivery_status,            
-        }), 200
+    row = db.session.execute(
+        select(*ORDER_DETAIL_FIELDS.values()).where(Order.id == order_id)
+    ).first()
+    if row:
+        return jsonify(dict(zip(ORDER_DETAIL_FIELDS, row))), 200
     else:
         return jsonify({'error': 'Order not found'}), 404
 
@@ -644,32 +1550,8 @@ def update_order():
 # Endpoint to get all orders
 @app.route('/api/get_orders', methods=['GET'])
 def get_orders():
-    orders = Order.query.all()  # Fetch all orders from the database
-    return jsonify([{
-        'id': order.id,
-        'name': order.name,
-        'phoneNumber': order.phone_number,
-        'district': order.district,
-        'price': order.price,
-        'quantity': order.quantity,
-        'quantityText': order.quantity_text,
-        'remainingAmount': order.remaining_amount,
-        'address': order.address,
-        'email': order.email,
-        'cargoBarcode': order.cargo_barcode,
-        'gtsBarcode': order.gts_barcode,
-        'tc': order.tc,
-        'birthday': order.birthday,
-        'isReceiptDone': order.is_receipt_done,
-        'isGTSDone': order.is_gts_done,
-        'source': order.source,
-        'lastUpdate': order.last_update,
-        'orderType': order.order_type,
-        'activityLogId': order.activity_log_id,
-        'purchaseDate': order.purchase_date,
-        'comments': order.comments,
-        'deliveryStatus': order.delivery_status,
-    } for order in orders])
+    rows, next_after, paginated = run_list_query(Order, [requested_fields(ORDER_FIELDS)], Order.id)
+    return list_response([order for _, order in rows], next_after, paginated)
 
 @app.route('/api/delete_order/<int:item_id>', methods=['DELETE'])
 def delete_order(item_id):
@@ -684,6 +1566,71 @@ def delete_order(item_id):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Smaller copies of every upload, written by a background pool so the upload
+# request doesn't wait for them: images/thumb/<id>.jpg for lists and
+# images/preview/<id>.jpg for the detail screen. max_side is the longest side
+# in pixels.
+IMAGE_VARIANTS = {
+    'thumb': {'max_side': int(os.environ.get('IMAGE_THUMB_SIZE', 320)), 'quality': 70},
+    'preview': {'max_side': int(os.environ.get('IMAGE_PREVIEW_SIZE', 1280)), 'quality': 80},
+}
+IMAGE_SIZES = ('full', *IMAGE_VARIANTS)
+# An image id can be uploaded again, so clients revalidate (cheaply, by
+# ETag) after this many seconds instead of caching forever
+IMAGE_CACHE_MAX_AGE = int(os.environ.get('IMAGE_CACHE_MAX_AGE', 3600))
+
+image_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('IMAGE_WORKERS', 2)), thread_name_prefix='image')
+_pending_images = set()
+_pending_images_lock = threading.Lock()
+
+def image_path(image_id, size='full'):
+    if size == 'full':
+        return os.path.join(UPLOAD_FOLDER, f"{image_id}.jpg")
+    return os.path.join(UPLOAD_FOLDER, size, f"{image_id}.jpg")
+
+def write_image_variants(image_id):
+    try:
+        variants = sorted(IMAGE_VARIANTS.items(), key=lambda item: item[1]['max_side'], reverse=True)
+        largest = variants[0][1]['max_side']
+        with Image.open(image_path(image_id)) as image:
+            # Lets the JPEG decoder scale down while decoding, which is much
+            # cheaper than decoding the full camera resolution
+            image.draft('RGB', (largest, largest))
+            image = ImageOps.exif_transpose(image).convert('RGB')
+            # Largest first, each variant shrinks the previous one in place
+            for size, variant in variants:
+                image.thumbnail((variant['max_side'], variant['max_side']))
+                target = image_path(image_id, size)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # Written aside and renamed, so get_image never sends half a file
+                partial = f"{target}.partial"
+                image.save(partial, 'JPEG', quality=variant['quality'], optimize=True, progressive=True)
+                os.replace(partial, target)
+    except Exception:
+        app.logger.exception("Could not write image variants for %s", image_id)
+    finally:
+        with _pending_images_lock:
+            _pending_images.discard(image_id)
+
+def schedule_image_variants(image_id):
+    if Image is None:
+        return
+    with _pending_images_lock:
+        if image_id in _pending_images:
+            return
+        _pending_images.add(image_id)
+    image_executor.submit(write_image_variants, image_id)
+
+def fresh_variant_path(image_id, size):
+    # The variant, if it was written from the current original
+    variant_path = image_path(image_id, size)
+    try:
+        if os.path.getmtime(variant_path) >= os.path.getmtime(image_path(image_id)):
+            return variant_path
+    except OSError:
+        pass
+    return None
+
 @app.route('/api/upload', methods=['POST'])
 def upload():
     if 'image' not in request.files:
@@ -700,21 +1647,40 @@ def upload():
         filename = f"{image_id}.jpg"  # Optionally prepend the image ID to the filename
         file_path = os.path.join(UPLOAD_FOLDER, filename)
         file.save(file_path)
+        schedule_image_variants(image_id)
         return jsonify({'message': 'File uploaded successfully', 'file_path': file_path}), 200
     else:
         return jsonify({'error': 'File type not allowed'}), 400
 
 @app.route('/api/get_image/<file_id>', methods=['GET'])
 def get_image(file_id):
+    # ?size=thumb|preview|full, full by default
+    size = request.args.get('size', 'full')
+    if size not in IMAGE_SIZES:
+        return jsonify({'error': f"Unknown size '{size}', expected one of {', '.join(IMAGE_SIZES)}"}), 400
+
     # Construct the file path
-    file_path = os.path.join("images", f"{file_id}.jpg")  # Assuming images are in JPG format
+    file_path = image_path(file_id)
 
     # Check if the file exists
-    if os.path.exists(file_path):
-        return send_file(file_path)  # Send the image file
-    else:
+    if not os.path.exists(file_path):
         abort(404)  # Return a 404 error if the file does not exist
 
+    max_age = IMAGE_CACHE_MAX_AGE
+    if size != 'full':
+        variant_path = fresh_variant_path(file_id, size)
+        if variant_path:
+            file_path = variant_path
+        else:
+            # Still being written, or uploaded before variants existed: send
+            # the original for now, uncached, and have the variant made
+            schedule_image_variants(file_id)
+            max_age = 0
+
+    # conditional=True answers If-None-Match/If-Modified-Since with 304 and
+    # serves Range requests; the ETag and Last-Modified come from the file
+    return send_file(file_path, mimetype='image/jpeg', conditional=True, max_age=max_age)
+
 
 @app.route("/payments/add", methods=["POST"])
 def add_payment():
@@ -726,8 +1692,7 @@ def add_payment():
     method = data.get("method", "Cash")
     note = data.get("note", "")
 
-    order = ClientOrder.query.get(order_id)
-    if not order:
+    if db.session.get(ClientOrder, order_id) is None:
         return jsonify({"error": "Order not found"}), 404
 
     payment = PaymentLog(
@@ -739,27 +1704,25 @@ def add_payment():
         payment_date=payment_date
     )
 
-    order.remaining_amount = (order.remaining_amount or 0) - amount  # Update received money
-
     db.session.add(payment)
+    subtract_from_remaining_amounts({order_id: amount})  # Update received money
+    add_to_order_balance(order_id, amount)
+    bump_table_versions(db.session, 'payment_log', 'client_order')
+    record_changes(db.session, [
+        {'entity': 'payment', 'id': payment_id, 'op': 'create'},
+        {'entity': 'client_order', 'id': order_id, 'fields': ['remainingAmount']},
+    ])
     db.session.commit()
 
     return jsonify({"message": "Payment added successfully", "payment_id": payment.id}), 200
 
 @app.route("/payments/<order_id>", methods=["GET"])
+@versioned(orders_tables=('payment_log',))
 def get_payments(order_id):
-    payments = PaymentLog.query.filter_by(order_id=order_id).all()
-    return jsonify([
-        {
-            "id": p.id,
-            "order_id": p.order_id,
-            "amount": p.amount,
-            "payment_date": p.payment_date,
-            "method": p.method,
-            "note": p.note
-        }
-        for p in payments
-    ])
+    rows, next_after, paginated = run_list_query(
+        PaymentLog, [requested_fields(PAYMENT_FIELDS)], PaymentLog.id, where=[PaymentLog.order_id == order_id]
+    )
+    return list_response([payment for _, payment in rows], next_after, paginated)
 
 @app.route("/payments/delete", methods=["POST"])
 def delete_payment():
@@ -772,107 +1735,404 @@ def delete_payment():
     if not payment:
         return jsonify({"error": "Payment not found"}), 404
     
-    order = ClientOrder.query.get(order_id)
-    if not order:
+    if db.session.get(ClientOrder, order_id) is None:
         return jsonify({"error": "Order not found"}), 404
 
-    order.remaining_amount = (order.remaining_amount or 0) + amount  # Update received money
-
     db.session.delete(payment)
+    subtract_from_remaining_amounts({order_id: -amount})  # Update received money
+    add_to_order_balance(payment.order_id, -payment.amount)
+    bump_table_versions(db.session, 'payment_log', 'client_order')
+    record_changes(db.session, [
+        {'entity': 'payment', 'id': payment_id, 'op': 'delete'},
+        {'entity': 'client_order', 'id': payment.order_id, 'fields': ['remainingAmount']},
+    ])
     db.session.commit()
 
     return jsonify({"message": "Payment updated successfully", "payment_id": payment.id}), 200
 
-@app.route('/api/get_gts_status/<string:barcode>', methods=['GET'])
-def get_gts_status(barcode):
-    product_db = next(get_product_db())
+PAYMENT_IMPORT_COLUMNS = ('payment_id', 'order_id', 'amount', 'payment_date', 'method', 'note')
+PAYMENT_IMPORT_MAX_ROWS = int(os.environ.get('PAYMENT_IMPORT_MAX_ROWS', 20000))
+
+class PaymentImportError(ValueError):
+    pass
+
+def read_payment_csv(file):
+    # Decoded from bytes: on Python 3.9 the SpooledTemporaryFile behind an
+    # upload can't be wrapped in a TextIOWrapper
+    text_stream = io.StringIO(file.read().decode('utf-8-sig'), newline='')
+    sample = text_stream.read(4096)
+    text_stream.seek(0)
     try:
-        # Search for barcode
-        products = product_db.query(Product).filter(Product.barcode == barcode).all()
-        if not products:
-            # If not found by barcode, search by package_barcode
-            products = product_db.query(Product).filter(Product.package_barcode == barcode).all()
+        # Bank exports here are usually ';' separated
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    for line_number, record in enumerate(csv.DictReader(text_stream, dialect=dialect), start=2):
+        yield line_number, record
+
+def read_payment_xlsx(file):
+    sheet = load_workbook(file.stream, read_only=True, data_only=True).worksheets[0]
+    rows = sheet.iter_rows(values_only=True)
+    header = [str(cell).strip() if cell is not None else '' for cell in next(rows, ())]
+    for line_number, values in enumerate(rows, start=2):
+        if any(value is not None for value in values):
+            yield line_number, dict(zip(header, values))
+
+def read_payment_import():
+    # (row number, record) pairs from a JSON body - a list of payments or
+    # {"payments": [...]} - or an uploaded CSV/XLSX whose header row uses
+    # the same column names
+    if 'file' in request.files:
+        file = request.files['file']
+        extension = file.filename.rsplit('.', 1)[-1].lower() if '.' in file.filename else ''
+        if extension == 'csv':
+            return read_payment_csv(file)
+        if extension == 'xlsx':
+            return read_payment_xlsx(file)
+        raise PaymentImportError("Only .csv and .xlsx files can be imported")
+
+    data = request.get_json(silent=True)
+    payments = data.get('payments') if isinstance(data, dict) else data
+    if not isinstance(payments, list) or not all(isinstance(payment, dict) for payment in payments):
+        raise PaymentImportError("Expected a list of payments or a CSV/XLSX file")
+    return enumerate(payments, start=1)
+
+# Largest amount an SQLite INTEGER column holds
+PAYMENT_AMOUNT_MAX = 2 ** 63 - 1
+
+def parse_payment_amount(value):
+    # Parsed as a Decimal, so large amounts aren't rounded and "inf",
+    # "nan" or "1e400" are rejected instead of overflowing. Bank exports
+    # write "1.500,00": when a comma comes last it is the decimal separator
+    # and the dots group thousands, otherwise commas group thousands.
+    if isinstance(value, str):
+        value = value.strip().replace(' ', '')
+        if value.rfind(',') > value.rfind('.'):
+            value = value.replace('.', '').replace(',', '.')
         else:
-            return jsonify({'is_gts_done': products[0].is_gts_done}), 200
-            
-        if products:
-            retVal = True
-            for p in products:
-                retVal = retVal and p.is_gts_done
-                
-            return jsonify({'is_gts_done': retVal}), 200
-        
+            value = value.replace(',', '')
+    try:
+        amount = decimal.Decimal(str(value))
+    except decimal.InvalidOperation:
+        raise ValueError
+    if not amount.is_finite() or amount != amount.to_integral_value() or not 0 < amount <= PAYMENT_AMOUNT_MAX:
+        raise ValueError
+    return int(amount)
+
+def parse_payment_record(record):
+    # A PaymentLog row from one import record; raises PaymentImportError
+    record = {key.strip().lower(): value for key, value in record.items() if isinstance(key, str)}
+    values = {}
+    for column in PAYMENT_IMPORT_COLUMNS:
+        value = record.get(column)
+        if isinstance(value, datetime):
+            value = value.strftime('%Y-%m-%d %H:%M:%S')
+        elif isinstance(value, str):
+            value = value.strip()
+        values[column] = None if value == '' else value
+
+    missing = [column for column in ('payment_id', 'order_id', 'amount', 'payment_date') if values[column] is None]
+    if missing:
+        raise PaymentImportError(f"Missing {', '.join(missing)}")
+    try:
+        amount = parse_payment_amount(values['amount'])
+    except (TypeError, ValueError):
+        raise PaymentImportError(f"Invalid amount '{values['amount']}', expected a positive whole number")
+
+    return {
+        'id': str(values['payment_id']),
+        'order_id': str(values['order_id']),
+        'amount': amount,
+        'payment_date': str(values['payment_date']),
+        'method': values['method'] or "Cash",
+        'note': values['note'] or "",
+    }
+
+@app.route("/payments/import", methods=["POST"])
+def import_payments():
+    # Bulk /payments/add for bank statements. Order ids and earlier imports
+    # are checked with one IN query per chunk; payments with an unknown order
+    # or an id that exists already (or repeats in the input) are reported and
+    # skipped, the rest are inserted in one transaction together with one
+    # aggregated remaining_amount/ledger update per order. ?dry_run=true only
+    # reports.
+    dry_run = request.args.get('dry_run', 'false').lower() == 'true'
+    try:
+        records = list(read_payment_import())
+    except PaymentImportError as e:
+        return jsonify({"error": str(e)}), 400
+    except (UnicodeDecodeError, csv.Error, zipfile.BadZipFile, OSError, ValueError) as e:
+        return jsonify({"error": f"Could not read the file: {e}"}), 400
+    if len(records) > PAYMENT_IMPORT_MAX_ROWS:
+        return jsonify({"error": f"At most {PAYMENT_IMPORT_MAX_ROWS} payments can be imported at once"}), 400
+
+    invalid = []
+    payments = []
+    for row, record in records:
+        try:
+            payments.append((row, parse_payment_record(record)))
+        except PaymentImportError as e:
+            invalid.append({"row": row, "error": str(e)})
+
+    order_ids = {payment['order_id'] for _, payment in payments}
+    payment_ids = {payment['id'] for _, payment in payments}
+    known_orders = set()
+    for chunk in chunked(order_ids):
+        known_orders.update(db.session.scalars(select(ClientOrder.id).where(ClientOrder.id.in_(chunk))))
+    existing_payments = set()
+    for chunk in chunked(payment_ids):
+        existing_payments.update(db.session.scalars(select(PaymentLog.id).where(PaymentLog.id.in_(chunk))))
+
+    duplicates = []
+    unknown_orders = []
+    to_insert = []
+    seen = set()
+    for row, payment in payments:
+        if payment['id'] in existing_payments:
+            duplicates.append({"row": row, "payment_id": payment['id'], "reason": "already imported"})
+        elif payment['id'] in seen:
+            duplicates.append({"row": row, "payment_id": payment['id'], "reason": "repeated in this import"})
+        elif payment['order_id'] not in known_orders:
+            unknown_orders.append({"row": row, "payment_id": payment['id'], "order_id": payment['order_id']})
+        else:
+            seen.add(payment['id'])
+            to_insert.append(payment)
+
+    totals = defaultdict(int)
+    for payment in to_insert:
+        totals[payment['order_id']] += payment['amount']
+
+    if to_insert and not dry_run:
+        try:
+            db.session.execute(insert(PaymentLog), to_insert)
+            subtract_from_remaining_amounts(totals)
+            add_to_order_balances(totals)
+            bump_table_versions(db.session, 'payment_log', 'client_order')
+            # One record per order rather than per payment, so a statement
+            # import doesn't flush the ring buffer
+            record_changes(db.session, [
+                {'entity': 'payment', 'op': 'bulk'},
+                *({'entity': 'client_order', 'id': order_id, 'fields': ['remainingAmount']} for order_id in totals),
+            ])
+            db.session.commit()
+        except IntegrityError:
+            # Another import inserted some of these ids in the meantime
+            db.session.rollback()
+            return jsonify({"error": "Some payments were imported concurrently, nothing was imported. Please retry."}), 409
+
+    return jsonify({
+        "message": "Dry run, nothing was imported" if dry_run else f"{len(to_insert)} payments imported",
+        "dry_run": dry_run,
+        "imported": len(to_insert),
+        "total_amount": sum(totals.values()),
+        "orders_updated": len(totals),
+        "duplicates": duplicates,
+        "unknown_orders": unknown_orders,
+        "invalid": invalid,
+    }), 200
+
+class ProductDataWatch:
+    # PRAGMA data_version on a dedicated connection changes whenever another
+    # connection commits to products.db - a request in any worker or one of
+    # the gts scripts - so caches built from products can tell they are stale.
+    def __init__(self, engine):
+        self.path = engine.url.database
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def current(self):
+        with self._lock:
+            if self._connection is None or self._pid != os.getpid():
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+                self._pid = os.getpid()
+            return self._connection.execute("PRAGMA data_version").fetchone()[0]
+
+product_data_watch = ProductDataWatch(product_engine)
+
+class BarcodeCache:
+    # Bounded LRU of resolved barcodes. Unknown codes are cached too, for a
+    # shorter time, so repeated scans of a bad label skip the database.
+    # Entries belong to one products.db data_version: a commit from any
+    # worker or gts script empties the cache on the next lookup, so no worker
+    # serves a GTS state another one already changed. The TTL is a backstop.
+    def __init__(self, max_entries, ttl, negative_ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+
+    def get(self, code, version):
+        # Returns (hit, value); value is None for a cached miss
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(code)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[code]
+                return False, None
+            self._entries.move_to_end(code)
+            return True, value
+
+    def put(self, code, value, version):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self._lock:
+            self._check_version(version)
+            self._entries[code] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(code)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *codes):
+        with self._lock:
+            for code in codes:
+                self._entries.pop(code, None)
+
+barcode_cache = BarcodeCache(
+    max_entries=int(os.environ.get('BARCODE_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('BARCODE_CACHE_TTL', 60)),
+    negative_ttl=float(os.environ.get('BARCODE_CACHE_NEGATIVE_TTL', 10)),
+)
+
+def resolve_barcode(product_db, barcode):
+    # Looks a scanned code up as a product barcode or a package barcode in one
+    # query. Returns (search_type, product dicts), or None if nothing matches.
+    # An exact product barcode wins over a package with the same code.
+    rows = product_db.execute(
+        select(Product.__table__).where(or_(Product.barcode == barcode, Product.package_barcode == barcode))
+    ).mappings().all()
+
+    exact = [dict(row) for row in rows if row['barcode'] == barcode]
+    if exact:
+        return "barkod", exact
+    if rows:
+        return "paket barkodu", [dict(row) for row in rows]
+    return None
+
+def resolve_barcode_cached(barcode):
+    # Read before the query: a commit in between leaves the entry under the
+    # old version, which the next lookup throws away
+    version = product_data_watch.current()
+    hit, resolved = barcode_cache.get(barcode, version)
+    if not hit:
+        with get_product_db() as product_db:
+            resolved = resolve_barcode(product_db, barcode)
+        barcode_cache.put(barcode, resolved, version)
+    return resolved
+
+def invalidate_products(barcodes, products):
+    # Drops every cache entry that may hold the given product rows
+    codes = set(barcodes)
+    for p in products:
+        codes.add(p['barcode'])
+        codes.add(p['package_barcode'])
+    barcode_cache.invalidate(*codes)
+    invalidate_package_index()
+
+@app.route('/api/get_gts_status/<string:barcode>', methods=['GET'])
+def get_gts_status(barcode):
+    resolved = resolve_barcode_cached(barcode)
+    if resolved is None:
         # Nothing found
-        return jsonify({'is_gts_done': retVal, 'status': 'error', 'message': f'{barcode} barkoduna sahip ürün bulunamadı.'}), 404
+        return jsonify({'is_gts_done': False, 'status': 'error', 'message': f'{barcode} barkoduna sahip ürün bulunamadı.'}), 404
 
-    finally:
-        product_db.close()
+    _, products = resolved
+    retVal = True
+    for p in products:
+        retVal = retVal and p['is_gts_done']
+
+    return jsonify({'is_gts_done': retVal}), 200
 
 @app.route('/api/get_product_details/<string:barcode>', methods=['GET'])
 def get_product_details(barcode):
-    product_db = next(get_product_db())
-    try:
-        # Search for barcode
-        products = product_db.query(Product).filter(Product.barcode == barcode).all()
-        if not products:
-            # If not found by barcode, search by package_barcode
-            products = product_db.query(Product).filter(Product.package_barcode == barcode).all()
-        
-        if products:
-            product_list = []
-            for p in products:
-                product_list.append({
-                    'barcode': p.barcode,
-                    'package_barcode': p.package_barcode,
-                    'pallet_barcode': p.pallet_barcode,
-                    'shipment_number': p.shipment_number,
-                    'delivery_number': p.delivery_number,
-                    'batch_number': p.batch_number,
-                    'production_date': p.production_date,
-                    'end_date': p.end_date,
-                    'order_id': p.order_id,
-                    'amount': p.amount,
-                    'is_gts_done': p.is_gts_done,
-                    'warehouse': p.warehouse,
-                    'in_stock': p.in_stock
-                })
-            return jsonify(product_list), 200
-
+    resolved = resolve_barcode_cached(barcode)
+    if resolved is None:
         # Nothing found
         return jsonify({'status': 'error', 'message': f'{barcode} barkoduna sahip ürün bulunamadı.'}), 404
 
-    finally:
-        product_db.close()
+    _, products = resolved
+    return jsonify(products), 200
+
+# Package-level aggregates for /api/products, rebuilt only when products.db changed
+_package_index = {'version': None, 'packages': None, 'totals': None}
+_package_index_lock = threading.Lock()
+
+def invalidate_package_index():
+    with _package_index_lock:
+        _package_index['version'] = None
+
+def build_package_index(product_db):
+    gts_done = case((Product.is_gts_done == True, 1), else_=0)
+    pending_amount = case((Product.is_gts_done == True, 0), else_=func.coalesce(Product.amount, 0))
+    rows = product_db.execute(
+        select(
+            Product.package_barcode,
+            func.count().label('count'),
+            func.sum(gts_done).label('gts_done'),
+            func.sum(pending_amount).label('pending_amount'),
+            func.max(Product.warehouse).label('warehouse'),
+            func.max(Product.in_stock).label('in_stock'),
+        ).group_by(Product.package_barcode)
+    ).all()
+
+    packages = []
+    totals = {'products': 0, 'gts_done': 0, 'pending_amount': 0, 'package_sizes': Counter()}
+    for row in rows:
+        packages.append({
+            'package_barcode': row.package_barcode,
+            'count': row.count,
+            'warehouse': row.warehouse,
+            'in_stock': bool(row.in_stock),
+            'pending_amount': row.pending_amount,
+            'all_gts_done': row.gts_done == row.count,
+        })
+        totals['products'] += row.count
+        totals['gts_done'] += row.gts_done
+        totals['pending_amount'] += row.pending_amount
+        totals['package_sizes'][(row.count, row.pending_amount)] += 1
+
+    packages.sort(key=lambda x: (not x['all_gts_done'], x['count']))
+    return packages, totals
+
+def get_package_index(product_db):
+    version = product_data_watch.current()
+    with _package_index_lock:
+        if _package_index['version'] == version:
+            return _package_index['packages'], _package_index['totals']
+
+    packages, totals = build_package_index(product_db)
+    with _package_index_lock:
+        _package_index.update(version=version, packages=packages, totals=totals)
+    return packages, totals
 
 @app.route('/api/products', methods=['GET'])
+@versioned(product_tables=('products',))
 def get_all_products_grouped():
-    product_db = next(get_product_db())
-    try:
-        products = product_db.query(Product).all()
+    # ?expand=products adds the per-barcode detail to every package
+    expand_products = request.args.get('expand') == 'products'
 
-        if not products:
+    with get_product_db() as product_db:
+        packages, totals = get_package_index(product_db)
+
+        if not packages:
             return jsonify({'status': 'error', 'message': 'Veritabanında ürün bulunamadı.'}), 404
 
-        grouped = defaultdict(list)
-        for product in products:
-            grouped[product.package_barcode].append(product)
-
-        result = []
-        total_products = 0
-        total_packages = 0
-        total_gts_done = 0
-        total_gts_not_done = 0
-        package_size_counter = Counter()
-        total_pending_amount = 0
-
-        for package_barcode, product_list in grouped.items():
-            products_data = []
-            all_gts_done = all(p.is_gts_done for p in product_list)
-            package_pending_amount = 0
-            warehouse = ""
-            in_stock = False
-            for p in product_list:
-                products_data.append({
+        if expand_products:
+            products_by_package = defaultdict(list)
+            for p in product_db.execute(
+                select(Product.package_barcode, Product.barcode, Product.warehouse, Product.order_id,
+                       Product.is_gts_done, Product.in_stock, Product.amount)
+            ):
+                products_by_package[p.package_barcode].append({
                     'barcode': p.barcode,
                     'warehose': p.warehouse,
                     'order_id': p.order_id,
@@ -880,45 +2140,22 @@ def get_all_products_grouped():
                     'in_stock': p.in_stock,
                     'amount': p.amount,
                 })
-                warehouse = p.warehouse
-                in_stock = p.in_stock
-                total_products += 1
-
-                if p.is_gts_done:
-                    total_gts_done += 1
-                else:
-                    total_gts_not_done += 1
-                    package_pending_amount += p.amount or 0  # Only pending ones
-
-            package_size = len(product_list)
-            package_size_counter[(package_size, package_pending_amount)] += 1
-
-            result.append({
-                'package_barcode': package_barcode,
-                'count': package_size,
-                'warehouse': warehouse,
-                'in_stock': in_stock,
-                'pending_amount': package_pending_amount,
-                'all_gts_done': all_gts_done,
-                'products': products_data
-            })
+            packages = [dict(package, products=products_by_package[package['package_barcode']])
+                        for package in packages]
 
-            total_packages += 1
-            total_pending_amount += package_pending_amount
-
-        result.sort(
-            key=lambda x: (not x['all_gts_done'], x['count'])
-        )
+        total_products = totals['products']
+        total_gts_done = totals['gts_done']
+        total_gts_not_done = total_products - total_gts_done
 
         # Create the basic summary
         basic_summary = (
-            f"Toplam {total_packages} kolide {total_products} GTS barkodlu {total_pending_amount} lt ürün kaldı depoda.\n"
+            f"Toplam {len(packages)} kolide {total_products} GTS barkodlu {totals['pending_amount']} lt ürün kaldı depoda.\n"
             f"{total_gts_done} ürünün GTS'si tamamlandı. {total_gts_not_done} tane işlenmemiş barkod mevcut."
         )
 
         # Create the detailed unique count summary
         detailed_summary_lines = []
-        for (package_size, pending_amount), count in sorted(package_size_counter.items(), reverse=True):
+        for (package_size, pending_amount), count in sorted(totals['package_sizes'].items(), reverse=True):
             if pending_amount > 0:
                 detailed_summary_lines.append(
                     f"{count} tane {package_size}x0.25'lik kolide {pending_amount} lt ürün var."
@@ -928,12 +2165,9 @@ def get_all_products_grouped():
         return jsonify({
             'summary': basic_summary,
             'detailed_summary': detailed_summary,
-            'packages': result
+            'packages': packages
         }), 200
 
-    finally:
-        product_db.close()
-
 @app.route('/api/update_product', methods=['POST'])
 def update_product():
     data = request.json
@@ -941,34 +2175,247 @@ def update_product():
     order_id = data.get('order_id')
     is_gts_done = data.get('is_gts_done')
 
-    product_db = next(get_product_db())
-    products_to_update = []
-    search_type = "barkod"
-
+    with get_product_db() as product_db:
+        try:
+            # Writes always resolve against the database, never the cache
+            resolved = resolve_barcode(product_db, barcode)
+            if resolved is None:
+                return jsonify({'status': 'error', 'message': f"'{barcode}' paket barkodu olan ürün bulunamadı."}), 404
+
+            search_type, products_to_update = resolved
+            match_column = Product.barcode if search_type == "barkod" else Product.package_barcode
+            product_db.execute(
+                update(Product).where(match_column == barcode).values(order_id=order_id, is_gts_done=is_gts_done)
+            )
+            bump_table_versions(product_db, 'products')
+            product_db.commit()
+            invalidate_products([barcode], products_to_update)
+            record_product_changes([(barcode, search_type)])
+            return jsonify({'status': 'success', 'message': f"{len(products_to_update)} adet ürünün GTS durumu ve sipariş ID'si güncellendi (arama türü: {search_type})."}), 200
+
+        except Exception as e:
+            print(e)
+            product_db.rollback()
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def record_product_changes(matches):
+    # GTS changes for /events, one per scanned (code, search type). The
+    # products live in products.db, so these are recorded right after its
+    # commit; the update already succeeded, so a failure here is only logged.
     try:
-        product = product_db.query(Product).filter(Product.barcode == barcode).first()
-        if product:
-            products_to_update.append(product)
-        else:
-            search_type = "paket barkodu"
-            products_to_update = product_db.query(Product).filter(Product.package_barcode == barcode).all()
-
-        if not products_to_update:
-            return jsonify({'status': 'error', 'message': f"'{barcode}' {search_type} olan ürün bulunamadı."}), 404
-
-        for product in products_to_update:
-            product.order_id = order_id
-            product.is_gts_done = is_gts_done
-
-        product_db.commit()
-        return jsonify({'status': 'success', 'message': f"{len(products_to_update)} adet ürünün GTS durumu ve sipariş ID'si güncellendi (arama türü: {search_type})."}), 200
-
-    except Exception as e:
-        print(e)
-        product_db.rollback()
-        return jsonify({'status': 'error', 'message': str(e)}), 500
-    finally:
-        product_db.close()
+        record_changes(db.session, [
+            {'entity': 'package' if search_type == "paket barkodu" else 'product', 'id': code,
+             'fields': ['order_id', 'is_gts_done']}
+            for code, search_type in dict(matches).items()
+        ])
+        db.session.commit()
+    except Exception:
+        app.logger.exception("Could not record product changes")
+        db.session.rollback()
+
+# Most entries /api/update_products takes per request, and most codes per
+# IN (...) list, well below SQLite's bound-parameter limit
+UPDATE_PRODUCTS_MAX_ITEMS = int(os.environ.get('UPDATE_PRODUCTS_MAX_ITEMS', 1000))
+IN_CHUNK_SIZE = 500
+
+def chunked(values, size=IN_CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def resolve_barcodes(product_db, codes):
+    # Set-based resolve_barcode for many scanned codes: every product whose
+    # barcode or package barcode is one of the codes, in one query per chunk.
+    # Returns {code: (search_type, product dicts)} for the codes found; the
+    # dicts only carry barcode and package_barcode.
+    by_barcode = {}
+    # package -> {barcode: product}; a product can come back from two chunks,
+    # once for its barcode and once for its package
+    by_package = defaultdict(dict)
+    for chunk in chunked(set(codes)):
+        rows = product_db.execute(
+            select(Product.barcode, Product.package_barcode)
+            .where(or_(Product.barcode.in_(chunk), Product.package_barcode.in_(chunk)))
+        ).mappings()
+        for row in rows:
+            product = dict(row)
+            by_barcode[product['barcode']] = product
+            by_package[product['package_barcode']][product['barcode']] = product
+
+    resolved = {}
+    for code in codes:
+        # Same precedence as resolve_barcode: an exact barcode wins
+        if code in by_barcode:
+            resolved[code] = ("barkod", [by_barcode[code]])
+        elif code in by_package:
+            resolved[code] = ("paket barkodu", list(by_package[code].values()))
+    return resolved
+
+@app.route('/api/update_products', methods=['POST'])
+def update_products():
+    # Batch form of /api/update_product for a run of scans: takes a list of
+    # {barcode, order_id, is_gts_done} (or {"items": [...]}) and applies them
+    # all in one transaction. Later entries win where they overlap, as if
+    # they had been sent one by one.
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return jsonify({'status': 'error', 'message': "Geçersiz istek: {barcode, order_id, is_gts_done} listesi bekleniyor."}), 400
+    if len(items) > UPDATE_PRODUCTS_MAX_ITEMS:
+        return jsonify({'status': 'error', 'message': f"Tek istekte en fazla {UPDATE_PRODUCTS_MAX_ITEMS} kayıt gönderilebilir."}), 400
+    missing = [index for index, item in enumerate(items) if not item.get('barcode')]
+    if missing:
+        return jsonify({'status': 'error', 'message': f"Barkodu olmayan kayıtlar: {', '.join(map(str, missing))}."}), 400
+    invalid = [index for index, item in enumerate(items)
+               if isinstance(item['barcode'], bool) or not isinstance(item['barcode'], (str, int))]
+    if invalid:
+        return jsonify({'status': 'error', 'message': f"Geçersiz barkodlu kayıtlar (metin veya sayı olmalı): {', '.join(map(str, invalid))}."}), 400
+
+    with get_product_db() as product_db:
+        try:
+            # Writes always resolve against the database, never the cache
+            resolved = resolve_barcodes(product_db, [item['barcode'] for item in items])
+
+            results = []
+            final_values = {}
+            updated_products = {}
+            for item in items:
+                barcode = item['barcode']
+                if barcode not in resolved:
+                    results.append({'barcode': barcode, 'status': 'not_found'})
+                    continue
+                search_type, products = resolved[barcode]
+                for product in products:
+                    final_values[product['barcode']] = (item.get('order_id'), item.get('is_gts_done'))
+                    updated_products[product['barcode']] = product
+                results.append({'barcode': barcode, 'status': 'updated', 'search_type': search_type,
+                                'updated': len(products)})
+
+            # One UPDATE ... WHERE barcode IN (...) per distinct value pair,
+            # usually a single one since a batch is scanned for one order
+            by_values = defaultdict(list)
+            for product_barcode, values in final_values.items():
+                by_values[values].append(product_barcode)
+            for (order_id, is_gts_done), product_barcodes in by_values.items():
+                for chunk in chunked(product_barcodes):
+                    product_db.execute(
+                        update(Product).where(Product.barcode.in_(chunk)).values(order_id=order_id, is_gts_done=is_gts_done)
+                    )
+
+            if final_values:
+                bump_table_versions(product_db, 'products')
+            product_db.commit()
+            invalidate_products(resolved, updated_products.values())
+            record_product_changes([(result['barcode'], result['search_type'])
+                                    for result in results if result['status'] == 'updated'])
+        except Exception as e:
+            app.logger.exception("Product update failed")
+            product_db.rollback()
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    not_found = [result['barcode'] for result in results if result['status'] == 'not_found']
+    return jsonify({
+        'status': 'success',
+        'message': f"{len(final_values)} adet ürünün GTS durumu ve sipariş ID'si güncellendi.",
+        'updated': len(final_values),
+        'package_matches': sum(1 for result in results if result.get('search_type') == "paket barkodu"),
+        'barcode_matches': sum(1 for result in results if result.get('search_type') == "barkod"),
+        'not_found': not_found,
+        'results': results,
+    }), 200
+
+# Per-order aggregates of the barcodes assigned in products.db, read through
+# ATTACH so they can be joined with client_order in one statement
+GTS_ASSIGNED_SQL = """
+    SELECT order_id,
+           COUNT(*) AS barcodes,
+           SUM(CASE WHEN is_gts_done = 1 THEN 1 ELSE 0 END) AS done,
+           SUM(COALESCE(amount, 0)) AS liters
+    FROM productdb.products
+    WHERE order_id IS NOT NULL AND order_id != ''
+    GROUP BY order_id
+"""
+
+GTS_RECONCILE_SQL = f"""
+    WITH assigned AS ({GTS_ASSIGNED_SQL})
+    SELECT o.id, o.client_id, o.quantity, o.is_gts_done,
+           COALESCE(a.barcodes, 0) AS barcodes,
+           COALESCE(a.done, 0) AS done,
+           COALESCE(a.liters, 0) AS liters,
+           a.barcodes > 0 AND a.done = a.barcodes AND COALESCE(o.is_gts_done, 0) = 0 AS done_not_marked,
+           o.is_gts_done = 1 AND COALESCE(a.done, 0) < COALESCE(a.barcodes, 0) AS marked_with_pending,
+           (a.barcodes > 0 OR o.is_gts_done = 1)
+               AND ABS(COALESCE(a.liters, 0) - COALESCE(o.quantity, 0)) > 0.000001 AS liters_mismatch
+    FROM client_order o LEFT JOIN assigned a ON a.order_id = o.id
+    WHERE done_not_marked OR marked_with_pending OR liters_mismatch
+"""
+
+GTS_UNKNOWN_ORDERS_SQL = f"""
+    SELECT a.order_id, a.barcodes FROM ({GTS_ASSIGNED_SQL}) a
+    WHERE NOT EXISTS (SELECT 1 FROM client_order o WHERE o.id = a.order_id)
+"""
+
+# Sets ClientOrder.is_gts_done from its barcodes wherever the two disagree
+GTS_FIX_SQL = f"""
+    UPDATE client_order SET is_gts_done = a.done = a.barcodes
+    FROM ({GTS_ASSIGNED_SQL}) AS a
+    WHERE a.order_id = client_order.id
+      AND COALESCE(client_order.is_gts_done, 0) != (a.done = a.barcodes)
+"""
+
+@contextmanager
+def products_attached():
+    # An orders connection with products.db attached as "productdb"
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql("ATTACH DATABASE ? AS productdb", (os.path.abspath(product_engine.url.database),))
+        try:
+            yield connection
+        finally:
+            connection.rollback()
+            connection.exec_driver_sql("DETACH DATABASE productdb")
+
+# GET reports orders whose GTS state disagrees with their barcodes;
+# POST also sets ClientOrder.is_gts_done from the barcodes before reporting
+@app.route('/api/reconcile_gts', methods=['GET', 'POST'])
+def reconcile_gts():
+    fixed = 0
+    with products_attached() as connection:
+        if request.method == 'POST':
+            fixed = connection.execute(text(GTS_FIX_SQL)).rowcount
+            if fixed:
+                bump_table_versions(connection, 'client_order')
+                record_changes(connection, [{'entity': 'client_order', 'op': 'bulk', 'fields': ['isGTSDone']}])
+            connection.commit()
+
+        report = {
+            'all_barcodes_done_not_marked': [],
+            'marked_done_with_pending': [],
+            'liters_mismatch': [],
+        }
+        for row in connection.execute(text(GTS_RECONCILE_SQL)).mappings():
+            item = {
+                'order_id': row['id'],
+                'client_id': row['client_id'],
+                'is_gts_done': None if row['is_gts_done'] is None else bool(row['is_gts_done']),
+                'barcodes': row['barcodes'],
+                'done_barcodes': row['done'],
+                'assigned_liters': row['liters'],
+                'quantity': row['quantity'],
+            }
+            if row['done_not_marked']:
+                report['all_barcodes_done_not_marked'].append(item)
+            if row['marked_with_pending']:
+                report['marked_done_with_pending'].append(item)
+            if row['liters_mismatch']:
+                report['liters_mismatch'].append(item)
+
+        report['unknown_orders'] = [
+            {'order_id': row.order_id, 'barcodes': row.barcodes}
+            for row in connection.execute(text(GTS_UNKNOWN_ORDERS_SQL))
+        ]
+
+    report['fixed'] = fixed
+    return jsonify(report), 200
 
 @app.route('/api/update_gts_barcode', methods=['POST'])
 def update_order_gts():
@@ -986,57 +2433,194 @@ def update_order_gts():
 
     return jsonify({'message': 'Order gts updated successfully'}), 200
 
-# @app.route("/payments/summary", methods=["GET"])
-# def get_payment_summary():
-#     start_date_str = request.args.get("start_date")  # Expected: "YYYY-MM-DD"
-#     end_date_str = request.args.get("end_date")  # Expected: "YYYY-MM-DD"
-
-#     if not start_date_str or not end_date_str:
-#         return jsonify({"error": "Missing start_date or end_date"}), 400
-
-#     # Convert start_date and end_date to datetime objects
-#     start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
-#     end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
-
-#     # Query for weekly summary
-#     weekly_query = db.session.query(
-#         func.strftime("%Y-%W", func.date(PaymentLog.payment_date, 'start of month')).label("week"),
-#         PaymentLog.method,
-#         func.sum(PaymentLog.amount).label("total_amount")
-#     ).filter(
-#         func.strftime("%d/%m/%Y", PaymentLog.payment_date).between(
-#             start_date.strftime("%d/%m/%Y"), end_date.strftime("%d/%m/%Y")
-#         )
-#     ).group_by("week", PaymentLog.method).order_by("week").all()
-
-#     # Query for monthly summary
-#     monthly_query = db.session.query(
-#         func.strftime("%Y-%m", func.date(PaymentLog.payment_date, 'start of month')).label("month"),
-#         PaymentLog.method,
-#         func.sum(PaymentLog.amount).label("total_amount")
-#     ).filter(
-#         func.strftime("%d/%m/%Y", PaymentLog.payment_date).between(
-#             start_date.strftime("%d/%m/%Y"), end_date.strftime("%d/%m/%Y")
-#         )
-#     ).group_by("month", PaymentLog.method).order_by("month").all()
-
-#     # Format the results
-#     weekly_summary = {}
-#     for week, method, total in weekly_query:
-#         if week not in weekly_summary:
-#             weekly_summary[week] = {"iyzico": 0, "havale": 0, "nakit": 0}
-#         weekly_summary[week][method] = total
-
-#     monthly_summary = {}
-#     for month, method, total in monthly_query:
-#         if month not in monthly_summary:
-#             monthly_summary[month] = {"iyzico": 0, "havale": 0, "nakit": 0}
-#         monthly_summary[month][method] = total
-
-#     return jsonify({
-#         "weekly": weekly_summary,
-#         "monthly": monthly_summary
-#     })
+# One period later, to step from a period start to the next one
+PAYMENT_PERIOD_STEP = {'day': '+1 day', 'week': '+7 days', 'month': '+1 month'}
+PAYMENT_SUMMARY_KEYS = {'day': 'daily', 'week': 'weekly', 'month': 'monthly'}
+
+def payment_period_start(period, value):
+    return db.session.execute(text(f"SELECT {PAYMENT_PERIOD_SQL[period].format(':value')}"), {'value': value}).scalar()
+
+def refresh_payment_rollups(period):
+    """Roll up every closed period of this type that isn't rolled up yet.
+
+    Closed periods are the ones before the period containing today. Writes
+    to payment_log move rolled_up_until back when they land in a rolled up
+    period (see migrations.py), so those are recomputed here too. Returns
+    rolled_up_until, the start of the current period.
+    """
+    today = PAYMENT_PERIOD_SQL[period].format("'now', 'localtime'")
+    current_start = db.session.execute(text(f"SELECT {today}")).scalar()
+    rolled_up_until = db.session.execute(
+        text("SELECT rolled_up_until FROM payment_rollup_state WHERE period = :period"), {'period': period}
+    ).scalar()
+    if rolled_up_until is not None and rolled_up_until >= current_start:
+        return rolled_up_until
+
+    start = rolled_up_until or ''
+    db.session.execute(
+        text("DELETE FROM payment_rollups WHERE period = :period AND period_start >= :start"),
+        {'period': period, 'start': start}
+    )
+    db.session.execute(text(
+        "INSERT INTO payment_rollups (period, period_start, method, total_amount, payment_count) "
+        f"SELECT :period, {PAYMENT_PERIOD_SQL[period].format('paid_at')} AS period_start, COALESCE(method, ''), "
+        "SUM(amount), COUNT(*) FROM payment_log WHERE paid_at >= :start AND paid_at < :until "
+        "GROUP BY period_start, COALESCE(method, '')"
+    ), {'period': period, 'start': start, 'until': current_start})
+    db.session.execute(text(
+        "INSERT INTO payment_rollup_state (period, rolled_up_until) VALUES (:period, :until) "
+        "ON CONFLICT(period) DO UPDATE SET rolled_up_until = excluded.rolled_up_until"
+    ), {'period': period, 'until': current_start})
+    db.session.commit()
+    return current_start
+
+def summarize_payments_live(period, start, end):
+    # (period start, method, total) for payments with start <= paid_at < end
+    return db.session.execute(text(
+        f"SELECT {PAYMENT_PERIOD_SQL[period].format('paid_at')} AS period_start, COALESCE(method, '') AS method, "
+        "SUM(amount) FROM payment_log WHERE paid_at >= :start AND paid_at < :end "
+        "GROUP BY period_start, COALESCE(method, '')"
+    ), {'start': start, 'end': end}).all()
+
+def summarize_payments(period, start, end):
+    # Periods that lie entirely within [start, end) and are closed come from
+    # payment_rollups; the partial periods at either edge and the current
+    # period are aggregated from payment_log over the paid_at index
+    rolled_up_until = refresh_payment_rollups(period)
+    first_full = payment_period_start(period, start)
+    if first_full != start:
+        first_full = db.session.execute(
+            text("SELECT date(:value, :step)"), {'value': first_full, 'step': PAYMENT_PERIOD_STEP[period]}
+        ).scalar()
+    rollup_end = min(payment_period_start(period, end), rolled_up_until)
+
+    if first_full < rollup_end:
+        rows = db.session.execute(text(
+            "SELECT period_start, method, total_amount FROM payment_rollups "
+            "WHERE period = :period AND period_start >= :start AND period_start < :end"
+        ), {'period': period, 'start': first_full, 'end': rollup_end}).all()
+        rows += summarize_payments_live(period, start, first_full)
+        rows += summarize_payments_live(period, rollup_end, end)
+    else:
+        rows = summarize_payments_live(period, start, end)
+
+    summary = {}
+    for period_start, method, total in sorted(rows):
+        key = period_start[:7] if period == 'month' else period_start
+        totals = summary.setdefault(key, {})
+        totals[method] = totals.get(method, 0) + total
+    return summary
+
+@app.route("/payments/summary", methods=["GET"])
+@versioned(orders_tables=('payment_log',))
+def get_payment_summary():
+    start_date_str = request.args.get("start_date")  # Expected: "YYYY-MM-DD"
+    end_date_str = request.args.get("end_date")  # Expected: "YYYY-MM-DD", inclusive
+    # ?periods=day,week,month; weeks are keyed by their Monday, months by "YYYY-MM"
+    periods = request.args.get("periods", "week,month").split(",")
+
+    if not start_date_str or not end_date_str:
+        return jsonify({"error": "Missing start_date or end_date"}), 400
+    unknown = [period for period in periods if period not in PAYMENT_PERIOD_SQL]
+    if unknown:
+        return jsonify({"error": f"Unknown periods: {', '.join(unknown)}"}), 400
+
+    try:
+        start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
+        end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
+    except ValueError:
+        return jsonify({"error": "Dates must be given as YYYY-MM-DD"}), 400
+
+    # paid_at values compare as text, "YYYY-MM-DD HH:MM:SS"
+    start = start_date.strftime("%Y-%m-%d")
+    end = (end_date + timedelta(days=1)).strftime("%Y-%m-%d")
+    return jsonify({
+        PAYMENT_SUMMARY_KEYS[period]: summarize_payments(period, start, end) for period in periods
+    })
+
+EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', 1.0))
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+# A stream ends after this long and the browser's EventSource reconnects
+# with Last-Event-ID, so no stream holds a worker thread for good
+EVENTS_STREAM_MAX_AGE = float(os.environ.get('EVENTS_STREAM_MAX_AGE', 600))
+# Each open stream occupies one gunicorn thread (GUNICORN_THREADS per
+# worker); the rest stay free for the API
+event_stream_slots = threading.BoundedSemaphore(int(os.environ.get('EVENTS_MAX_STREAMS', 2)))
+EVENTS_BATCH = 500
+
+def format_change_event(row):
+    data = {
+        'version': row.id,
+        'entity': row.entity,
+        'id': row.entity_id,
+        'op': row.op,
+        'fields': app.json.loads(row.fields) if row.fields else None,
+    }
+    return f"id: {row.id}\nevent: change\ndata: {app.json.dumps(data)}\n\n"
+
+def iter_change_events(engine, last_event_id):
+    yield "retry: 3000\n\n"
+    with engine.connect() as connection:
+        oldest, newest = connection.execute(text("SELECT MIN(id), MAX(id) FROM change_event")).one()
+    newest = newest or 0
+    if last_event_id is None:
+        cursor = newest
+    elif last_event_id > newest or (oldest is not None and last_event_id < oldest - 1):
+        # The requested point was trimmed from the buffer (or the buffer
+        # was reset): the client has to reload its lists
+        yield f"id: {newest}\nevent: reset\ndata: {{}}\n\n"
+        cursor = newest
+    else:
+        cursor = last_event_id
+
+    deadline = time.monotonic() + EVENTS_STREAM_MAX_AGE
+    last_sent = time.monotonic()
+    while time.monotonic() < deadline:
+        # A short-lived connection per poll; writes from every worker
+        # process show up here
+        with engine.connect() as connection:
+            rows = connection.execute(
+                select(ChangeEvent.__table__).where(ChangeEvent.id > cursor).order_by(ChangeEvent.id).limit(EVENTS_BATCH)
+            ).all()
+        for row in rows:
+            yield format_change_event(row)
+            cursor = row.id
+        if rows:
+            last_sent = time.monotonic()
+            if len(rows) == EVENTS_BATCH:
+                continue
+        elif time.monotonic() - last_sent >= EVENTS_HEARTBEAT:
+            # Keeps proxies from closing the stream, and finds out about
+            # clients that went away
+            yield ": keepalive\n\n"
+            last_sent = time.monotonic()
+        time.sleep(EVENTS_POLL_INTERVAL)
+
+# Server-sent change feed: one "change" event per committed write with the
+# entity, its id, the operation and the changed response keys. Reconnects
+# resume after Last-Event-ID (or ?last_event_id=); a "reset" event means the
+# client missed changes and should refetch its lists.
+@app.route('/events', methods=['GET'])
+def events():
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_event_id is not None and not last_event_id.isdigit():
+        return jsonify({'error': 'Last-Event-ID must be a number'}), 400
+
+    if not event_stream_slots.acquire(blocking=False):
+        response = jsonify({'error': 'Too many open event streams, try again later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '10'
+        return response
+
+    stream = iter_change_events(db.engine, int(last_event_id) if last_event_id is not None else None)
+    response = Response(stream, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Tell nginx not to buffer the stream
+        'X-Accel-Buffering': 'no',
+    })
+    # The server closes the response whether or not the stream was started
+    response.call_on_close(event_stream_slots.release)
+    return response
 
 BACKEND_AVAILABLE = True
 
@@ -1047,62 +2631,167 @@ def health_check():
     else:
         return jsonify({"status": "maintenance"}), 503
 
-from sqlalchemy.exc import IntegrityError
+MIGRATION_JOB = 'migrate_orders_to_clients'
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', 500))
+# A 'running' job whose checkpoint is older than this is treated as crashed
+JOB_STALE_AFTER = 300
+
+def _now_text():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def claim_migration_job():
+    # Marks the job running unless a live run (in any worker) holds it.
+    # Returns the resume cursor, or raises LookupError if already running.
+    # The insert takes SQLite's write lock first, so checking and claiming the
+    # row cannot interleave with another worker doing the same
+    db.session.execute(sqlite_insert(JobProgress).values(job=MIGRATION_JOB, status='new').on_conflict_do_nothing())
+    progress = db.session.get(JobProgress, MIGRATION_JOB, populate_existing=True)
+    if progress.status == 'running' and progress.updated_at and (
+            datetime.now() - datetime.strptime(progress.updated_at, '%Y-%m-%d %H:%M:%S')).total_seconds() < JOB_STALE_AFTER:
+        db.session.rollback()
+        raise LookupError(MIGRATION_JOB)
+
+    # Clients and orders already migrated are skipped, so a finished job
+    # simply runs again over any orders added since
+    cursor = progress.cursor if progress.status != 'done' else None
+    remaining = db.session.query(func.count(Order.id))
+    if cursor is not None:
+        remaining = remaining.filter(Order.id > cursor)
+
+    progress.cursor = cursor
+    progress.processed = 0
+    progress.total = remaining.scalar()
+    progress.status = 'running'
+    progress.started_at = progress.updated_at = _now_text()
+    db.session.commit()
+    return cursor
 
-@app.route('/api/migrate_orders_to_clients_and_client_orders', methods=['GET'])
-def migrate_orders_to_clients_and_client_orders():
-    orders = Order.query.all()
+def migrate_orders_batch(orders):
+    # Copies one batch of Order rows into Client/ClientOrder with bulk inserts
+    order_ids = [order.id for order in orders]
+    existing_clients = {id for (id,) in db.session.query(Client.id).filter(Client.id.in_(order_ids))}
+    existing_orders = {id for (id,) in db.session.query(ClientOrder.id).filter(ClientOrder.id.in_(order_ids))}
+
+    new_clients = {}
+    new_orders = []
     for order in orders:
-        # First, create or get the Client
-        client = Client(
-            id=order.id,  # Assuming phone_number is unique for Client ID (you can adjust this)
-            name=order.name,
-            phone_number=order.phone_number,
-            district=order.district,
-            address=order.address,
-            tc=order.tc,
-            birthday=order.birthday,
-            source=order.source if order.source else "Unknown",
-            comments=order.comments,
-            email=order.email,
-            title="Müşteri",  # You can set a default title; adjust if needed
-            gts_number=""
-        )
+        if order.id not in existing_clients and order.id not in new_clients:
+            new_clients[order.id] = {
+                'id': order.id,
+                'name': order.name,
+                'phone_number': order.phone_number,
+                'district': order.district,
+                'address': order.address,
+                'tc': order.tc,
+                'birthday': order.birthday,
+                'source': order.source if order.source else "Unknown",
+                'comments': order.comments,
+                'email': order.email,
+                'title': "Müşteri",
+                'gts_number': "",
+            }
+        if order.id not in existing_orders:
+            new_orders.append({
+                'id': order.id,
+                'client_id': order.id,
+                'quantity': order.quantity,
+                'quantity_text': order.quantity_text,
+                'price': order.price,
+                'remaining_amount': order.remaining_amount,
+                'is_receipt_done': order.is_receipt_done,
+                'is_gts_done': order.is_gts_done,
+                'cargo_barcode': order.cargo_barcode,
+                'gts_barcode': order.gts_barcode,
+                'order_type': order.order_type,
+                'last_update': order.last_update,
+                'purchase_date': order.purchase_date,
+                'comments': order.comments,
+                'delivery_status': order.delivery_status,
+            })
 
+    if new_clients:
+        db.session.execute(insert(Client), list(new_clients.values()))
+    if new_orders:
+        db.session.execute(insert(ClientOrder), new_orders)
+
+def run_orders_migration(cursor):
+    with app.app_context():
         try:
-            db.session.add(client)
-            db.session.commit()
-        except IntegrityError:
-            # Client already exists (same ID/phone number), rollback and continue
+            while True:
+                query = db.session.query(Order).order_by(Order.id)
+                if cursor is not None:
+                    query = query.filter(Order.id > cursor)
+                orders = query.limit(MIGRATION_BATCH_SIZE).all()
+                if not orders:
+                    break
+
+                migrate_orders_batch(orders)
+                cursor = orders[-1].id
+                # Checkpoint in the same transaction as the batch
+                db.session.query(JobProgress).filter(JobProgress.job == MIGRATION_JOB).update({
+                    'cursor': cursor,
+                    'processed': JobProgress.processed + len(orders),
+                    'updated_at': _now_text(),
+                })
+                bump_table_versions(db.session, 'client', 'client_order')
+                record_changes(db.session, [{'entity': 'client', 'op': 'bulk'}, {'entity': 'client_order', 'op': 'bulk'}])
+                db.session.commit()
+                db.session.expunge_all()
+
+            status = 'done'
+        except Exception:
+            app.logger.exception("Order migration failed")
             db.session.rollback()
+            status = 'failed'
+
+        db.session.query(JobProgress).filter(JobProgress.job == MIGRATION_JOB).update(
+            {'status': status, 'updated_at': _now_text()})
+        db.session.commit()
+        print(f"Order migration finished: {status}.")
+
+def serialize_job_progress(progress):
+    if progress is None:
+        return {'job': MIGRATION_JOB, 'status': 'not_started'}
+
+    rows_per_second = None
+    eta_seconds = None
+    if progress.started_at and progress.updated_at:
+        elapsed = (datetime.strptime(progress.updated_at, '%Y-%m-%d %H:%M:%S')
+                   - datetime.strptime(progress.started_at, '%Y-%m-%d %H:%M:%S')).total_seconds()
+        if elapsed > 0 and progress.processed:
+            rows_per_second = round(progress.processed / elapsed, 1)
+            if progress.status == 'running' and progress.total is not None:
+                eta_seconds = round(max(progress.total - progress.processed, 0) / rows_per_second)
 
-        # Then, create the ClientOrder
-        client_order = ClientOrder(
-            id=order.id,
-            client_id=client.id,
-            quantity=order.quantity,
-            quantity_text=order.quantity_text,
-            price=order.price,
-            remaining_amount=order.remaining_amount,
-            is_receipt_done=order.is_receipt_done,
-            is_gts_done=order.is_gts_done,
-            cargo_barcode=order.cargo_barcode,
-            gts_barcode=order.gts_barcode,
-            order_type=order.order_type,
-            last_update=order.last_update,
-            purchase_date=order.purchase_date,
-            comments=order.comments,
-            delivery_status=order.delivery_status,
-            intermediar_id=order.intermediar_id,
-            intermediar_amount=order.intermediar_amount,
-            product_type=order.product_type
-        )
-
-        db.session.add(client_order)
+    return {
+        'job': progress.job,
+        'status': progress.status,
+        'cursor': progress.cursor,
+        'processed': progress.processed,
+        'total': progress.total,
+        'startedAt': progress.started_at,
+        'updatedAt': progress.updated_at,
+        'rowsPerSecond': rows_per_second,
+        'etaSeconds': eta_seconds,
+    }
 
-    db.session.commit()
-    print("Migration completed successfully.")
-    return 200
+# Starts (or resumes) the migration in a background thread. GET is kept for
+# existing callers.
+@app.route('/api/migrate_orders_to_clients_and_client_orders', methods=['GET', 'POST'])
+def migrate_orders_to_clients_and_client_orders():
+    try:
+        cursor = claim_migration_job()
+    except LookupError:
+        progress = db.session.get(JobProgress, MIGRATION_JOB)
+        return jsonify({'message': 'Migration is already running.', **serialize_job_progress(progress)}), 409
+
+    threading.Thread(target=run_orders_migration, args=(cursor,), daemon=True).start()
+    progress = db.session.get(JobProgress, MIGRATION_JOB)
+    return jsonify({'message': 'Migration started.', **serialize_job_progress(progress)}), 202
+
+@app.route('/api/migrate_orders_to_clients_and_client_orders/status', methods=['GET'])
+def migrate_orders_status():
+    return jsonify(serialize_job_progress(db.session.get(JobProgress, MIGRATION_JOB))), 200
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8082)
\ No newline at end of file